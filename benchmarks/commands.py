@@ -0,0 +1,183 @@
+"""Command Engine Benchmarks
+
+Replays a command corpus against the command engine on each storage backend and reports throughput,
+latency percentiles and allocations. Run it from the repository root:
+
+    python -m benchmarks.commands [--corpus FILE] [--backend memory|json|sqlite] [--count N]
+
+A corpus holds one command per line as "<guild> <author> <message>"; lines starting with # are ignored.
+Without a corpus, a synthetic one mixing rolls, checks, macros, odds and session commands is generated.
+"""
+
+import argparse
+import asyncio
+import configparser
+import json
+import random
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from dnd_roller import CommandEngine
+from utils.metrics import Metrics
+
+BACKENDS = ["memory", "json", "sqlite"]
+
+SETUP = [
+    "!c create {name} {level} 16 12 14 8 10 13 | str con | athletics perception survival | stealth",
+    "!m set attack 1d20+$str_mod+$prof",
+    "!m set damage 2d6+$str_mod",
+    "!v set bless 1d4",
+    "!v set rage 2",
+    "!s weekday saturday",
+]
+
+WORKLOAD = [
+    (20, "!r 1d20+5"),
+    (10, "!r 4d6kh3"),
+    (15, "!r athletics"),
+    (10, "!r perception a bless"),
+    (5, "!r dex save d"),
+    (15, "!r attack"),
+    (10, "!r damage crit"),
+    (3, "!o athletics a vs 15"),
+    (2, "!sim 1000 damage"),
+    (3, "!c info"),
+    (2, "!m list"),
+    (2, "!v list"),
+    (2, "!s next"),
+    (1, "!s list"),
+]
+
+
+def synthetic_corpus(count: int, guilds: int, users: int, seed: int) -> tuple:
+    """Builds the setup commands and a weighted random workload for every guild and user"""
+    rng = random.Random(seed)
+    setup = []
+    for guild in range(guilds):
+        for user in range(users):
+            for command in SETUP:
+                setup.append((str(guild), str(user), command.format(name=f"hero{user}", level=rng.randint(1, 20))))
+
+    weights = [weight for weight, _ in WORKLOAD]
+    commands = [command for _, command in WORKLOAD]
+    corpus = [(str(rng.randrange(guilds)), str(rng.randrange(users)), command) for command in rng.choices(commands, weights, k=count)]
+    return setup, corpus
+
+
+def read_corpus(path: str) -> list:
+    """Reads a corpus file of "<guild> <author> <message>" lines"""
+    corpus = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                guild, author, message = line.split(" ", 2)
+                corpus.append((guild, author, message))
+    return corpus
+
+
+async def replay(backend: str, setup: list, corpus: list, seed: int) -> dict:
+    """Replays the corpus against a fresh engine and returns its throughput and latency figures"""
+    with tempfile.TemporaryDirectory() as directory:
+        config = configparser.ConfigParser()
+        config.read_dict({"General": {"Backend": backend, "Storage": directory, "MetricsInterval": "3600"}})
+        engine = CommandEngine(config["General"])
+        await engine.open()
+
+        for guild, author, message in setup:
+            await engine.handle(message, guild, author, f"user{author}")
+        engine.metrics = Metrics()
+        random.seed(seed)
+
+        latencies = []
+        start = perf_counter()
+        for guild, author, message in corpus:
+            before = perf_counter()
+            await engine.handle(message, guild, author, f"user{author}")
+            latencies.append(perf_counter() - before)
+        elapsed = perf_counter() - start
+
+        before = perf_counter()
+        await engine.close()
+        closing = perf_counter() - before
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "backend": backend,
+        "commands": len(corpus),
+        "commands_per_sec": len(corpus) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "max_ms": max(latencies) * 1000,
+        "close_ms": closing * 1000,
+        "per_command": engine.metrics.report(),
+    }
+
+
+async def allocations(backend: str, setup: list, corpus: list, seed: int) -> dict:
+    """Replays the corpus again under tracemalloc, which is too slow to combine with the timing run"""
+    with tempfile.TemporaryDirectory() as directory:
+        config = configparser.ConfigParser()
+        config.read_dict({"General": {"Backend": backend, "Storage": directory, "MetricsInterval": "3600"}})
+        engine = CommandEngine(config["General"])
+        await engine.open()
+        for guild, author, message in setup:
+            await engine.handle(message, guild, author, f"user{author}")
+        random.seed(seed)
+
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        for guild, author, message in corpus:
+            await engine.handle(message, guild, author, f"user{author}")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        retained = sys.getallocatedblocks() - blocks
+        await engine.close()
+
+    return {"peak_kib": peak / 1024, "retained_blocks_per_command": retained / len(corpus)}
+
+
+async def main() -> None:
+    """Parses the arguments, runs the benchmarks and prints or saves the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--corpus", help="corpus file to replay instead of a synthetic one")
+    parser.add_argument("--backend", choices=BACKENDS, action="append", help="storage backend to test (default: all)")
+    parser.add_argument("--count", type=int, default=20000, help="synthetic corpus size")
+    parser.add_argument("--guilds", type=int, default=10, help="synthetic corpus guilds")
+    parser.add_argument("--users", type=int, default=20, help="synthetic corpus users per guild")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the corpus and the rolls")
+    parser.add_argument("--no-alloc", action="store_true", help="skip the allocation pass")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.corpus:
+        setup, corpus = [], read_corpus(args.corpus)
+    else:
+        setup, corpus = synthetic_corpus(args.count, args.guilds, args.users, args.seed)
+
+    results = []
+    for backend in args.backend or BACKENDS:
+        result = await replay(backend, setup, corpus, args.seed)
+        if not args.no_alloc:
+            result.update(await allocations(backend, setup, corpus, args.seed))
+        results.append(result)
+
+        print(f"== {backend}: {result['commands']} commands")
+        print(f"{result['commands_per_sec']:.0f} commands/s, close {result['close_ms']:.1f}ms")
+        print(f"p50 {result['p50_ms']:.3f}ms | p95 {result['p95_ms']:.3f}ms | p99 {result['p99_ms']:.3f}ms | max {result['max_ms']:.3f}ms")
+        if not args.no_alloc:
+            print(f"peak traced memory {result['peak_kib']:.0f}KiB, {result['retained_blocks_per_command']:.2f} blocks retained per command")
+        print(result["per_command"])
+        print()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,231 @@
+"""Concurrent Load Test
+
+Drives the Discord client offline with concurrent message streams from many guilds and users, the way
+the gateway would dispatch them, and reports end-to-end reply latency, event loop lag and storage flush
+behavior. Run it from the repository root:
+
+    python -m benchmarks.load [--guilds 500] [--users 5] [--rate 0.5] [--duration 30] [--backend json]
+
+Every guild sends messages as an open-loop Poisson stream, so a slow bot builds up a backlog instead of
+slowing the load down. Replies go to stand-in channels that wait --send-latency before returning, like a
+REST call to Discord would, and each guild gets its own channel with its own send queue.
+"""
+
+import argparse
+import asyncio
+import configparser
+import random
+import statistics
+import tempfile
+from datetime import date, timedelta
+from time import perf_counter
+from types import SimpleNamespace
+
+import discord
+
+from dnd_roller import DNDRoller
+
+SETUP = "!c create hero{user} {level} 16 12 14 8 10 13 | str con | athletics perception survival | stealth"
+
+WORKLOAD = [
+    (25, "!r 1d20+5"),
+    (20, "!r athletics a"),
+    (15, "!r 2d6+3"),
+    (10, "!r perception"),
+    (8, "!c update hero{user} main {level} 16 12 14 8 10 13"),
+    (5, "!v set bless 1d4"),
+    (5, "!c info"),
+    (5, "!s next"),
+    (4, "!s unavailable {day}"),
+    (2, "!s schedule {day}"),
+    (3, "!s list"),
+]
+
+
+class StandInChannel:
+    """Channel that takes a fixed time to send, like a REST call to Discord"""
+
+    def __init__(self, channel: int, latency: float):
+        self.id = channel
+        self.latency = latency
+        self.sent = 0
+
+    async def send(self, content: str) -> None:
+        """Waits for the simulated request and counts the message"""
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+class LoadTest:
+    """Runs the message streams against a client and collects the measurements"""
+
+    def __init__(self, client: DNDRoller, args: argparse.Namespace):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.channels = [StandInChannel(guild, args.send_latency / 1000) for guild in range(args.guilds)]
+        self.latencies = []
+        self.lags = []
+        self.backlog = []
+        self.writes = []
+        self.inflight = 0
+        self.tasks = set()
+
+    def message(self, guild: int, user: int, content: str) -> SimpleNamespace:
+        """Builds a stand-in for the discord.Message the gateway would dispatch"""
+        return SimpleNamespace(
+            content=content,
+            guild=SimpleNamespace(id=guild),
+            author=SimpleNamespace(id=guild * 1000 + user, display_name=f"user{user}"),
+            channel=self.channels[guild],
+        )
+
+    async def setup(self) -> None:
+        """Creates a character for every user and a weekly session for every guild before the load starts"""
+        engine = self.client.engine
+        for guild in range(self.args.guilds):
+            await engine.handle("!s weekday saturday", str(guild), str(guild * 1000), "user0")
+            for user in range(self.args.users):
+                content = SETUP.format(user=user, level=self.rng.randint(1, 20))
+                await engine.handle(content, str(guild), str(guild * 1000 + user), f"user{user}")
+
+    async def run(self) -> float:
+        """Runs every guild's stream for the configured duration and waits for the replies, returning the elapsed time"""
+        storage = self.client.engine.storage
+        write = storage._write  # pylint: disable=protected-access
+
+        async def timed_write(lines: list, guilds: set) -> None:
+            start = perf_counter()
+            await write(lines, guilds)
+            self.writes.append((perf_counter() - start, len(lines), len(guilds)))
+
+        storage._write = timed_write  # pylint: disable=protected-access
+        monitor = asyncio.create_task(self.monitor())
+
+        start = perf_counter()
+        await asyncio.gather(*(self.stream(guild) for guild in range(self.args.guilds)))
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+        elapsed = perf_counter() - start
+
+        monitor.cancel()
+        return elapsed
+
+    async def stream(self, guild: int) -> None:
+        """Sends one guild's messages as a Poisson stream"""
+        weights = [weight for weight, _ in WORKLOAD]
+        commands = [command for _, command in WORKLOAD]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.args.duration
+
+        while True:
+            delay = self.rng.expovariate(self.args.rate)
+            if loop.time() + delay >= deadline:
+                return
+            await asyncio.sleep(delay)
+
+            user = self.rng.randrange(self.args.users)
+            day = (date.today() + timedelta(days=self.rng.randint(1, 60))).isoformat()
+            content = self.rng.choices(commands, weights)[0].format(user=user, level=self.rng.randint(1, 20), day=day)
+            task = asyncio.create_task(self.deliver(self.message(guild, user, content)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, message: SimpleNamespace) -> None:
+        """Dispatches a message like the gateway does and times it until the last reply was sent"""
+        self.inflight += 1
+        start = perf_counter()
+        try:
+            await self.client.on_message(message)
+        finally:
+            self.latencies.append(perf_counter() - start)
+            self.inflight -= 1
+
+    async def monitor(self) -> None:
+        """Samples how late the event loop wakes up, the messages in flight and the unflushed records"""
+        loop = asyncio.get_running_loop()
+        interval = self.args.lag_interval / 1000
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.lags.append(loop.time() - start - interval)
+            self.backlog.append((self.inflight, self.client.engine.storage.pending))
+
+    def report(self, elapsed: float) -> str:
+        """Formats the collected measurements"""
+        storage = self.client.engine.storage
+        latency = percentiles(self.latencies)
+        lag = percentiles(self.lags)
+        lines = [
+            f"{len(self.latencies)} messages from {self.args.guilds} guilds in {elapsed:.1f}s ({len(self.latencies) / elapsed:.0f} messages/s)",
+            f"{sum(channel.sent for channel in self.channels)} messages sent",
+            f"reply latency: {latency}",
+            f"event loop lag: {lag}",
+            f"in flight: max {max(inflight for inflight, _ in self.backlog or [(0, 0)])} messages",
+            f"unflushed records: max {max(pending for _, pending in self.backlog or [(0, 0)])}",
+            f"storage: {storage.flushes} flushes, {storage.loads} loads, {storage.evictions} evictions, {storage.resident} resident guilds",
+        ]
+        if self.writes:
+            durations = [duration for duration, _, _ in self.writes]
+            lines.append(
+                f"flush writes: {percentiles(durations)}, "
+                f"{statistics.mean(records for _, records, _ in self.writes):.0f} records and "
+                f"{statistics.mean(guilds for _, _, guilds in self.writes):.0f} guilds on average"
+            )
+        lines += ["", self.client.engine.metrics.report()]
+        return "\n".join(lines)
+
+
+def percentiles(samples: list) -> str:
+    """Formats the p50/p95/p99/max of a list of durations in milliseconds"""
+    if len(samples) < 2:
+        return "not enough samples"
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return f"p50 {quantiles[49] * 1000:.2f}ms | p95 {quantiles[94] * 1000:.2f}ms | p99 {quantiles[98] * 1000:.2f}ms | max {max(samples) * 1000:.2f}ms"
+
+
+async def main() -> None:
+    """Parses the arguments, runs the load test and prints the report"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--guilds", type=int, default=500, help="number of guilds sending messages")
+    parser.add_argument("--users", type=int, default=5, help="users per guild")
+    parser.add_argument("--rate", type=float, default=0.5, help="messages per second per guild")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to keep sending")
+    parser.add_argument("--backend", choices=["memory", "json", "sqlite"], default="json", help="storage backend")
+    parser.add_argument("--flush-interval", type=float, default=5.0, help="storage flush interval in seconds")
+    parser.add_argument("--flush-max-delay", type=float, default=30.0, help="longest storage flush delay in seconds")
+    parser.add_argument("--max-guilds", type=int, default=1000, help="most guilds kept loaded at once")
+    parser.add_argument("--send-latency", type=float, default=50.0, help="simulated time to send a reply in milliseconds")
+    parser.add_argument("--lag-interval", type=float, default=10.0, help="event loop lag sampling interval in milliseconds")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = configparser.ConfigParser()
+        config.read_dict(
+            {
+                "General": {
+                    "Backend": args.backend,
+                    "Storage": directory,
+                    "FlushInterval": str(args.flush_interval),
+                    "FlushMaxDelay": str(args.flush_max_delay),
+                    "MaxResidentGuilds": str(args.max_guilds),
+                    "MetricsInterval": "3600",
+                }
+            }
+        )
+        client = DNDRoller(discord.Intents.default(), config["General"])
+        await client.engine.open()
+        try:
+            test = LoadTest(client, args)
+            await test.setup()
+            client.engine.metrics.histograms.clear()
+            elapsed = await test.run()
+        finally:
+            await client.engine.close()
+
+    print(test.report(elapsed))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
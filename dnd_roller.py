@@ -1,390 +1,737 @@
 """Main DnD Roller Bot App"""
 
+import asyncio
 import calendar
 import configparser
-import json
+import itertools
 import logging
 import math
+import multiprocessing
 import os
 import re
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from time import perf_counter
+from typing import Literal
 
 import d20
 import discord
 from dateutil.parser import parse
-from discord import Message
-
-from utils import strings
+from discord import Message, app_commands
+
+from utils import encounters, strings
+from utils.character import (
+    ABILITY_BITS,
+    SKILL_STATS,
+    SKILLS,
+    STAT_NAMES,
+    STATS,
+    Character,
+    DerivedStats,
+    check_scores,
+)
+from utils.commands import Command, register
+from utils.completion import MAX_CHOICES, PrefixIndex, UserNames, merge
+from utils.history import Entry, HistoryStore, describe_luck
+from utils.logs import setup_logging
+from utils.metrics import Metrics
+from utils.odds import OddsEngine, OddsError, exact_distribution, summarize
+from utils.outbox import Outbox, coalesce
+from utils.rolls import (
+    DICE,
+    MAX_LENGTH,
+    CostError,
+    ExpressionCache,
+    ResolveError,
+    classify_target,
+    expression_cost,
+    render_expression,
+    render_roll,
+    roll_tree,
+)
+from utils.schema import new_user
+from utils.sessions import SessionIndex
+from utils.simulate import SimulationError, describe, simulate
+from utils.storage import JSONStorage, MemoryStorage, SQLiteStorage
+
+command_log = logging.getLogger("dnd_roller.commands")
+
+# Rolls without a character use this one, so they share its derived stats instead of building them every time
+EMPTY_CHARACTER = Character(-7, [10] * len(STATS))  # 0 Prof Bonus
+
+
+class CommandEngine:
+    """Processes bot commands independently of Discord, turning a message and its guild/author into replies"""
+
+    def __init__(self, settings: configparser.SectionProxy):
+        backend = settings.get("Backend", "json")
+        if backend == "memory":
+            self.storage = MemoryStorage(
+                idle_time=settings.getfloat("GuildIdleTime", 3600.0),
+                max_guilds=settings.getint("MaxResidentGuilds", 1000),
+            )
+        else:
+            json_storage = JSONStorage(
+                settings["Storage"],
+                interval=settings.getfloat("FlushInterval", 5.0),
+                max_delay=settings.getfloat("FlushMaxDelay", 30.0),
+                compact_size=settings.getint("CompactSize", 1048576),
+                idle_time=settings.getfloat("GuildIdleTime", 3600.0),
+                max_guilds=settings.getint("MaxResidentGuilds", 1000),
+            )
+            if backend == "sqlite":
+                self.storage = SQLiteStorage(
+                    f"{settings['Storage']}/cache.db",
+                    legacy=json_storage,
+                    interval=settings.getfloat("FlushInterval", 5.0),
+                    max_delay=settings.getfloat("FlushMaxDelay", 30.0),
+                    idle_time=settings.getfloat("GuildIdleTime", 3600.0),
+                    max_guilds=settings.getint("MaxResidentGuilds", 1000),
+                )
+            else:
+                self.storage = json_storage
+        self.cache = self.storage.data
+
+        self.stats = STATS
+        self.skills = SKILLS
+        self.vocabulary = set(self.stats + self.skills + ["strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma"])
+        self.expressions = ExpressionCache(
+            settings.getint("ExpressionCacheSize", 1024), max_dice=settings.getint("MaxDice", 1000), max_depth=settings.getint("MaxDepth", 32)
+        )
+        self.offload_dice = settings.getint("OffloadDice", 100)
+        self.roll_workers = settings.getint("RollWorkers", 2)
+        self.roll_timeout = settings.getfloat("RollTimeout", 5.0)
+        self.roll_pool = None
+        self.odds = OddsEngine(settings.getint("OddsCacheSize", 256), settings.getint("MaxOddsCost", 5000000))
+        self.max_simulations = settings.getint("MaxSimulations", 1000000)
+        self.max_simulated_dice = settings.getint("MaxSimulatedDice", 100000000)
+        self.derived_size = settings.getint("DerivedCacheSize", 4096)
+        self._derived = OrderedDict()
+        self.rendered_size = settings.getint("RenderCacheSize", 1024)
+        self._rendered = OrderedDict()
+        self._sessions = OrderedDict()
+        self.names_size = settings.getint("NameIndexSize", 4096)
+        self._names = OrderedDict()
+        self._vocabulary = PrefixIndex(self.vocabulary)
+        self._weekdays = PrefixIndex(day.lower() for day in calendar.day_name)
+        self.history = HistoryStore(
+            os.path.join(settings["Storage"], "history") if backend != "memory" else None,
+            capacity=settings.getint("HistorySize", 10000),
+            max_open=settings.getint("HistoryOpenGuilds", 256),
+        )
+
+        self.metrics = Metrics()
+        self.metrics_file = settings.get("MetricsFile", os.path.join(settings.get("Storage", "."), "metrics.txt"))
+        self.metrics_interval = settings.getfloat("MetricsInterval", 60.0)
+        self.admins = set(settings.get("Admins", "").replace(",", " ").split())
+        self._metrics_task = None
+        self._register_commands()
+
+    async def open(self) -> None:
+        """Opens the storage, starts the roll worker processes and starts writing the metrics file"""
+        await self.storage.open()
+        if self.roll_pool is None and self.roll_workers > 0:
+            self.roll_pool = self._create_roll_pool()
+            # Start the workers now instead of on the first expensive roll
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self.roll_pool, render_expression, "1d1", "", "") for _ in range(self.roll_workers)))
+        if self._metrics_task is None:
+            self._metrics_task = asyncio.create_task(self._write_metrics())
+
+    async def close(self) -> None:
+        """Writes the metrics file, the roll histories and any pending changes and closes the storage"""
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+            await asyncio.to_thread(self.metrics.write, self.metrics_file, self._report_metrics())
+        if self.roll_pool is not None:
+            self.roll_pool.shutdown(wait=False, cancel_futures=True)
+            self.roll_pool = None
+        await self.history.close()
+        await self.storage.close()
+
+    async def handle(self, content: str, guild: str, author: str, name: str, channel: str = "None") -> list:
+        """Processes a message sent by an author in a guild channel and returns the replies to send"""
+        # Filter out normal messages and unknown commands
+        if not content.startswith("!"):
+            return []
+        fields = content.lower().split(" ")
+        command = self.commands.get(fields[0])
+        if command is None:
+            return []
+
+        target = command.route(fields)
+        replies = None
+        outcome = "ok"
+        start = perf_counter()
 
-logging.basicConfig(filename="/var/log/dnd-roller.log", encoding="utf-8", level=logging.DEBUG, format="%(asctime)s : %(message)s")
+        try:
+            # Only load the guild and initialize the author for commands that need user state. Commands of the same
+            # guild take turns, commands of different guilds run in parallel, and commands that are not exclusive
+            # only hold the lock while their author is set up
+            exclusive = command.user_state and target.exclusive
+            if command.user_state:
+                await self.storage.pin(guild)
+                async with self.storage.lock(guild):
+                    await self._init_user(guild, author, name)
+                    if exclusive:
+                        replies = await self._dispatch(command, target, guild, author, fields, channel)
+            if not exclusive:
+                replies = await self._dispatch(command, target, guild, author, fields, channel)
+        except Exception as ex:
+            outcome = type(ex).__name__
+            logging.exception(ex)
+        finally:
+            latency = perf_counter() - start
+            self.metrics.record(target.name, latency)
+            command_log.info("guild=%s command=%r latency_ms=%.2f outcome=%s", guild, target.name, latency * 1000, outcome)
+            if command.user_state:
+                self.storage.unpin(guild)
+
+        return [replies] if isinstance(replies, str) else list(replies or [])
+
+    async def complete(self, guild: str, author: str, kind: str, prefix: str, character: str = "") -> list:
+        """Returns the names of a kind starting with a prefix, for autocomplete
+
+        Kinds are character, target (a character's macros plus the stats and skills), macro, variable, weekday and session.
+        """
+        start = perf_counter()
+        prefix = prefix.lower()
+        state = await self.storage.load_guild(guild)
+        profile = state["users"].get(author)
+
+        if kind == "weekday":
+            names = self._weekdays.complete(prefix)
+        elif kind == "session":
+            names = [date for date in sorted(state["sessions"]["on"]) if date.startswith(prefix)][:MAX_CHOICES]
+        elif profile is None:
+            names = self._vocabulary.complete(prefix) if kind == "target" else []
+        else:
+            index = self._get_names(guild, author, profile)
+            character = character.lower() or profile["active"]
+            if kind == "character":
+                names = index.characters.complete(prefix)
+            elif kind == "target":
+                names = merge(index.of("macros", character).complete(prefix), self._vocabulary.complete(prefix))
+            else:
+                names = index.of(f"{kind}s", character).complete(prefix)
+
+        self.metrics.record("autocomplete", perf_counter() - start)
+        return names
+
+    async def _dispatch(self, command: Command, target: Command, guild: str, author: str, fields: list, channel: str):
+        if target is command and command.handler is None:
+            return command.usage
+        if target is not command and command.prepare is not None:
+            fields = await command.prepare(guild, author, fields)
+        if target.per_channel:
+            return await target.handler(guild, author, fields, channel)
+        return await target.handler(guild, author, fields)
+
+    def _get_names(self, guild: str, author: str, profile: dict) -> UserNames:
+        # Built on first use, then updated by the commands that add or remove names
+        index = self._names.get((guild, author))
+        if index is not None:
+            self._names.move_to_end((guild, author))
+            return index
+
+        index = self._names[(guild, author)] = UserNames(profile["characters"])
+        if len(self._names) > self.names_size:
+            self._names.popitem(last=False)
+        return index
+
+    def _register_commands(self) -> None:
+        self.commands = {}
+        register(self.commands, ["!r", "!roll"], Command("roll", self._get_roll, exclusive=False, per_channel=True))
+        register(self.commands, ["!o", "!odds"], Command("odds", self._get_odds, exclusive=False))
+        register(self.commands, ["!sim", "!simulate"], Command("simulate", self._get_simulation, exclusive=False))
+        register(
+            self.commands,
+            ["!c", "!char", "!character"],
+            Command("character", usage=strings.CHAR_HELP)
+            .add(["create", "c"], "create", self._create_character)
+            .add(["delete", "d"], "delete", self._delete_character)
+            .add(["update", "u"], "update", self._update_character)
+            .add(["active", "a"], "active", self._set_active_character)
+            .add(["info", "show", "i", "s"], "info", self._get_character)
+            .add(["list", "l"], "list", self._get_characters),
+        )
+        register(
+            self.commands,
+            ["!m", "!macro"],
+            Command("macro", usage=strings.VARS_HELP, prepare=self._insert_active_character)
+            .add(["set", "s"], "set", self._set_macro)
+            .add(["delete", "d"], "delete", self._delete_macro)
+            .add(["list", "l"], "list", self._get_macros),
+        )
+        register(
+            self.commands,
+            ["!v", "!var", "!variable"],
+            Command("variable", usage=strings.VARS_HELP, prepare=self._insert_active_character)
+            .add(["set", "s"], "set", self._set_variable)
+            .add(["delete", "d"], "delete", self._delete_variable)
+            .add(["list", "l"], "list", self._get_variables),
+        )
+        register(
+            self.commands,
+            ["!s", "!session"],
+            Command("session", usage=strings.SESSION_HELP, prepare=self._clean_sessions)
+            .add(["weekday", "w"], "weekday", self._set_session_weekday)
+            .add(["schedule", "s"], "schedule", self._schedule_session)
+            .add(["cancel", "c"], "cancel", self._cancel_session)
+            .add(["available", "a"], "available", self._set_available)
+            .add(["unavailable", "u"], "unavailable", self._set_unavailable)
+            .add(["list", "l"], "list", self._list_sessions)
+            .add(["next", "n"], "next", self._next_session),
+        )
+        register(
+            self.commands,
+            ["!i", "!init", "!initiative"],
+            Command("initiative", usage=strings.INIT_HELP, per_channel=True)
+            .add(["add", "a"], "add", self._add_combatant)
+            .add(["roll", "r"], "roll", self._roll_combatants)
+            .add(["next", "n"], "next", self._next_turn)
+            .add(["remove", "delete", "d"], "remove", self._remove_combatant)
+            .add(["show", "s"], "show", self._show_encounter)
+            .add(["end", "e"], "end", self._end_encounter),
+        )
+        register(self.commands, ["!history"], Command("history", self._get_history, per_channel=True))
+        register(self.commands, ["!luck"], Command("luck", self._get_luck))
+        register(self.commands, ["!d", "!distance"], Command("distance", self._get_distance, user_state=False))
+        register(self.commands, ["!f", "!fall"], Command("fall", self._get_fall_time, user_state=False))
+        register(self.commands, ["!h", "!help"], Command("help", self._get_help, user_state=False))
+        register(self.commands, ["!metrics"], Command("metrics", self._get_metrics, user_state=False))
+
+    async def _init_user(self, guild: str, author: str, name: str) -> None:
+        # The guild was normalized when it was loaded, so only a user new to it needs setting up
+        users = self.cache[guild]["users"]
+        if author not in users:
+            users[author] = new_user()
+        if users[author]["name"] != name:
+            self.storage.set([guild, "users", author, "name"], name)
+
+    async def _get_roll(self, guild: str, author: str, fields: list, channel: str) -> list:
+        # Rolls separated by semicolons are answered together, in one batch of replies
+        text = " ".join(fields[1:])
+        if ";" not in text:
+            return await self._get_group_roll(guild, author, fields, channel)
+
+        replies = []
+        for segment in text.split(";"):
+            if segment.split():
+                replies += await self._get_group_roll(guild, author, fields[:1] + segment.split(), channel)
+        return replies
+
+    async def _get_group_roll(self, guild: str, author: str, fields: list, channel: str) -> list:
+        users = self.cache[guild]["users"]
+        if len(fields) > 1 and fields[1] == "party" and "party" not in users[author]["characters"]:
+            # Everyone with an active character rolls
+            rolls = [
+                (user, [fields[0], profile["active"]] + fields[2:]) for user, profile in users.items() if profile["active"] in profile["characters"]
+            ]
+            if not rolls:
+                return ["Nobody here has an active character."]
+        elif len(fields) > 1 and "," in fields[1]:
+            names = [name for name in fields[1].split(",") if name]
+            for name in names:
+                if name not in users[author]["characters"]:
+                    return [f"No character named {name} exists for you."]
+            rolls = [(author, [fields[0], name] + fields[2:]) for name in names]
+        else:
+            rolls = [(author, fields)]
 
-config = configparser.ConfigParser()
-config.read(f"{os.getenv('HOME', 'root')}/.config/dnd-roller/config.ini")
+        return [await self._get_single_roll(guild, user, roll, channel) for user, roll in rolls]
 
+    async def _get_single_roll(self, guild: str, author: str, fields: list, channel: str) -> str:
+        if any(re.fullmatch(r"[0-9]+x", field) for field in fields[1:3]):
+            return await self._get_bulk_roll(guild, author, fields)
 
-class DNDRoller(discord.Client):
-    """Discord Client"""
+        try:
+            fields, character, modifiers, expression = await self._prepare_roll(guild, author, fields)
+            tree = self.expressions.parse(expression)
+            dice = self.expressions.check(tree)
+        except (ResolveError, CostError, d20.RollError) as ex:
+            return f"Error: {str(ex).rstrip('.')}."
+
+        summary = f"{await self._generate_roll_summary(fields[1], fields[2], modifiers, character.macros)}:\n"
+        budget = MAX_LENGTH - len(summary)
+        try:
+            # Rolls with many dice take milliseconds to evaluate and render, which is too long to block the loop for
+            if dice > self.offload_dice:
+                return f"{summary}{await self._render_in_worker(guild, channel, author, expression, budget)}"
+            roll = roll_tree(tree)
+            (await self.history.get(guild)).append(Entry.from_roll(channel, author, expression, roll))
+            return f"{summary}{render_roll(roll, budget)}"
+        except d20.RollError as ex:
+            return f"Error: {str(ex).rstrip('.')}."
+        except asyncio.TimeoutError:
+            return f"Error: The roll took longer than {self.roll_timeout:g}s."
+        except BrokenProcessPool:
+            return "Error: The roll crashed its worker."
+
+    async def _render_in_worker(self, guild: str, channel: str, author: str, expression: str, budget: int) -> str:
+        start = perf_counter()
+        try:
+            result, entry = await self._run_in_worker(render_expression, expression, channel, author, budget)
+        except asyncio.TimeoutError:
+            self.metrics.increment("rolls timed out")
+            raise
+        self.metrics.record("roll offloaded", perf_counter() - start)
+        (await self.history.get(guild)).append(entry)
+        return result
+
+    async def _run_in_worker(self, func, *args):
+        # A worker that died breaks the whole pool; replace it and retry once, so only a call that kills workers fails
+        for attempt in range(2):
+            pool = self.roll_pool
+            try:
+                return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(pool, func, *args), self.roll_timeout)
+            except BrokenProcessPool:
+                logging.exception("Roll worker pool broke, restarting it")
+                if self.roll_pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.roll_pool = self._create_roll_pool()
+                if attempt:
+                    raise
+        return None
+
+    def _create_roll_pool(self) -> ProcessPoolExecutor:
+        # Spawn the workers, as forking a process that runs the logging and storage threads is unsafe
+        return ProcessPoolExecutor(self.roll_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def _set_active_character(self, guild: str, author: str, fields: list) -> str:
+        if len(fields) == 2:
+            return f"You current active character is {self.cache[guild]['users'][author]['active'].capitalize()}."
+        if fields[2] in self.cache[guild]["users"][author]["characters"].keys():
+            self.storage.set([guild, "users", author, "active"], fields[2])
+            return f"{fields[2].capitalize()} set as the active character."
+        return "No such character exists for you."
 
-    def __init__(self, app_intents):
-        super().__init__(intents=app_intents)
+    async def _get_characters(self, guild: str, author: str, fields: list) -> str:
+        characters = [c.capitalize() for c in self.cache[guild]["users"][author]["characters"].keys()]
+        return f"Your characters are: {characters}."
+
+    async def _insert_active_character(self, guild: str, author: str, fields: list) -> list:
+        # Add the active character if missing from a 2 parameter command
+        if len(fields) == 2:
+            fields.append(self.cache[guild]["users"][author]["active"])
+
+        # If the character is missing from the command, add the active one
+        if fields[2] not in self.cache[guild]["users"][author]["characters"].keys():
+            fields = fields[:2] + [self.cache[guild]["users"][author]["active"]] + fields[2:]
+        return fields
+
+    async def _set_session_weekday(self, guild: str, author: str, fields: list) -> str:
+        day = [x.lower() for x in list(calendar.day_name)].index(fields[2].lower())
+        self.storage.set([guild, "sessions", "wday"], day)
+        self._sessions.pop(guild, None)
+        return f"Default session weekday set to {calendar.day_name[self.cache[guild]['sessions']['wday']]}."
+
+    async def _schedule_session(self, guild: str, author: str, fields: list) -> str:
+        date = parse(fields[2])
+        if date.date() < date.now().date():
+            return "I'm also eager, but even I cannot go back in time."
+
+        datestr = date.strftime("%Y-%m-%d")
+        if datestr in self.cache[guild]["sessions"]["on"] or (
+            date.weekday() == self.cache[guild]["sessions"]["wday"] and datestr not in self.cache[guild]["sessions"]["off"]
+        ):
+            return "We already have a session on that day."
+
+        if date.weekday() != self.cache[guild]["sessions"]["wday"]:
+            self.storage.set([guild, "sessions", "on"], self.cache[guild]["sessions"]["on"] + [datestr])
+
+        if datestr in self.cache[guild]["sessions"]["off"]:
+            self.storage.set([guild, "sessions", "off"], [s for s in self.cache[guild]["sessions"]["off"] if s != datestr])
+        self._sessions.pop(guild, None)
+        return f"Session scheduled to {datestr} :tada:"
+
+    async def _cancel_session(self, guild: str, author: str, fields: list) -> str:
+        date = parse(fields[2])
+        datestr = date.strftime("%Y-%m-%d")
+        if datestr in self.cache[guild]["sessions"]["on"]:
+            self.storage.set([guild, "sessions", "on"], [s for s in self.cache[guild]["sessions"]["on"] if s != datestr])
+            self._sessions.pop(guild, None)
+            return "Extra session cancelled."
+
+        if date.weekday() == self.cache[guild]["sessions"]["wday"]:
+            if datestr in self.cache[guild]["sessions"]["off"]:
+                return "This Sunday session was already cancelled."
+            self.storage.set([guild, "sessions", "off"], self.cache[guild]["sessions"]["off"] + [datestr])
+            self._sessions.pop(guild, None)
+            return "Sunday session cancelled."
+
+        return "Could not find an extra session scheduled for that date."
+
+    async def _set_available(self, guild: str, author: str, fields: list) -> str:
+        date = parse(fields[2])
+        datestr = date.strftime("%Y-%m-%d")
+        if datestr not in self.cache[guild]["sessions"]["on"] and date.weekday() != self.cache[guild]["sessions"]["wday"]:
+            return "I do not recall a session scheduled for that day."
+        if datestr not in self.cache[guild]["users"][author]["unavailability"]:
+            return "Didn't know you couldn't make it, but I'm glad to see you can make it!"
+
+        unavailability = [s for s in self.cache[guild]["users"][author]["unavailability"] if s != datestr]
+        self.storage.set([guild, "users", author, "unavailability"], unavailability)
+        self._sessions.pop(guild, None)
+        return "Glad to see you can make it!"
+
+    async def _set_unavailable(self, guild: str, author: str, fields: list) -> str:
+        date = parse(fields[2])
+        datestr = date.strftime("%Y-%m-%d")
+        if datestr not in self.cache[guild]["sessions"]["on"] and date.weekday() != self.cache[guild]["sessions"]["wday"]:
+            return "I do not recall a session scheduled for that day."
+        if datestr in self.cache[guild]["users"][author]["unavailability"]:
+            return "We know :("
+
+        self.storage.set([guild, "users", author, "unavailability"], self.cache[guild]["users"][author]["unavailability"] + [datestr])
+        self._sessions.pop(guild, None)
+        return "If we play, we'll try not to kill your character."
+
+    async def _list_sessions(self, guild: str, author: str, fields: list) -> list:
+        return ["Next four scheduled sessions:"] + await self._get_sessions(guild, 4)
+
+    async def _next_session(self, guild: str, author: str, fields: list) -> list:
+        return ["Next scheduled session:"] + await self._get_sessions(guild, 1)
+
+    async def _add_combatant(self, guild: str, author: str, fields: list, channel: str) -> str:
+        # A name followed by a number joins with a fixed initiative, anything else rolls for one of the author's characters
+        if len(fields) > 3 and fields[3].lstrip("-").isdigit():
+            if len(fields) > 4 and not fields[4].lstrip("-").isdigit():
+                return "Error: The dex modifier must be a number."
+            name, initiative, dex = fields[2], int(fields[3]), int(fields[4]) if len(fields) > 4 else 0
+            rolled = ""
+        else:
+            characters = self.cache[guild]["users"][author]["characters"]
+            name = fields[2] if len(fields) > 2 and fields[2] in characters else self.cache[guild]["users"][author]["active"]
+            if name not in characters:
+                return "Error: Expected '!init add [<character>] [a|d]' or '!init add <name> <initiative> [<dex mod>]'."
+
+            character = characters[name]
+            modifiers = {"mode": "n", "save": False, "crit": False, "vars": []}
+            for field in fields[2:]:
+                if field in ["a", "adv", "advantage"]:
+                    modifiers["mode"] = "a"
+                elif field in ["d", "dis", "disadvantage"]:
+                    modifiers["mode"] = "d"
+            expression = await self._get_character_roll(character, "dex", modifiers)
+            roll = roll_tree(self.expressions.parse(expression))
+            (await self.history.get(guild)).append(Entry.from_roll(channel, author, expression, roll))
+            initiative, dex = roll.total, await self._get_character_stat_mod(character, "dex")
+            rolled = f": {render_roll(roll, 1000)}"
+
+        encounter = self.cache[guild]["encounters"].get(channel) or encounters.new_encounter()
+        if encounters.find(encounter, name) >= 0:
+            return f"{name.capitalize()} is already in the encounter."
+        if len(encounter["order"]) >= encounters.MAX_COMBATANTS:
+            return f"Error: An encounter can have at most {encounters.MAX_COMBATANTS} combatants."
+
+        encounters.add(encounter, name, initiative, dex)
+        self.storage.set([guild, "encounters", channel], encounter)
+        return f"{name.capitalize()} joined the encounter with initiative {initiative}{rolled}"
+
+    async def _roll_combatants(self, guild: str, author: str, fields: list, channel: str) -> str:
+        if len(fields) < 4 or not re.fullmatch(r"[0-9]+x", fields[2]) or (len(fields) > 4 and not fields[4].lstrip("-").isdigit()):
+            return "Error: Expected '!init roll <count>x <name> [<dex mod>]'."
+
+        count, name, dex = int(fields[2][:-1]), fields[3], int(fields[4]) if len(fields) > 4 else 0
+        encounter = self.cache[guild]["encounters"].get(channel) or encounters.new_encounter()
+        if count < 1 or len(encounter["order"]) + count > encounters.MAX_COMBATANTS:
+            return f"Error: An encounter can have at most {encounters.MAX_COMBATANTS} combatants."
+
+        # The expression is parsed once and rolled for every combatant
+        expression = f"1d20{dex:+d}"
+        tree = self.expressions.parse(expression)
+        history = await self.history.get(guild)
+        taken = {entry[3] for entry in encounter["order"]}
+        names = (f"{name}{number}" for number in itertools.count(1) if f"{name}{number}" not in taken)
+        rolled = []
+        for combatant, _ in zip(names, range(count)):
+            roll = roll_tree(tree)
+            history.append(Entry.from_roll(channel, author, expression, roll))
+            initiative = roll.total
+            encounters.add(encounter, combatant, initiative, dex)
+            rolled.append(f"{combatant.capitalize()} {initiative}")
+
+        self.storage.set([guild, "encounters", channel], encounter)
+        return f"Rolled initiative ({expression}): {', '.join(rolled)}"
+
+    async def _next_turn(self, guild: str, author: str, fields: list, channel: str) -> str:
+        encounter = self.cache[guild]["encounters"].get(channel)
+        if not encounter or not encounter["order"]:
+            return "There is no encounter in this channel."
+
+        _, _, _, name = encounters.advance(encounter)
+        # Only the turn and round change, so the combatants are not written again
+        self.storage.set([guild, "encounters", channel, "turn"], encounter["turn"])
+        self.storage.set([guild, "encounters", channel, "round"], encounter["round"])
+        return f"Round {encounter['round']}: {name.capitalize()}'s turn."
+
+    async def _remove_combatant(self, guild: str, author: str, fields: list, channel: str) -> str:
+        encounter = self.cache[guild]["encounters"].get(channel)
+        if len(fields) < 3:
+            return "Error: Expected '!init remove <name>'."
+        if not encounter or not encounters.remove(encounter, fields[2]):
+            return f"{fields[2].capitalize()} is not in the encounter."
+
+        self.storage.set([guild, "encounters", channel], encounter)
+        return f"{fields[2].capitalize()} left the encounter."
+
+    async def _show_encounter(self, guild: str, author: str, fields: list, channel: str) -> str:
+        encounter = self.cache[guild]["encounters"].get(channel)
+        if not encounter or not encounter["order"]:
+            return "There is no encounter in this channel."
+        return encounters.render(encounter)
+
+    async def _end_encounter(self, guild: str, author: str, fields: list, channel: str) -> str:
+        if channel not in self.cache[guild]["encounters"]:
+            return "There is no encounter in this channel."
+        self.storage.delete([guild, "encounters", channel])
+        return "The encounter is over."
+
+    async def _get_history(self, guild: str, author: str, fields: list, channel: str) -> str:
+        count = next((int(field) for field in fields[1:] if field.isdigit()), 10)
+        names = [field for field in fields[1:] if not field.isdigit()]
+        user = await self._find_user(guild, author, names[0]) if names else None
+        if names and user is None:
+            return f"Nobody named {names[0]} rolled here."
+
+        # A player's rolls are listed across the server, otherwise the rolls of this channel are
+        history = await self.history.get(guild)
+        if user is not None:
+            entries = history.latest(min(count, 25), user=int(user))
+        else:
+            entries = history.latest(min(count, 25), channel=int(channel) if channel.isdigit() else 0)
+        if not entries:
+            return "No rolls to show."
+
+        users = self.cache[guild]["users"]
+        lines = []
+        for entry in reversed(entries):
+            name = users.get(str(entry.user), {}).get("name", "?")
+            natural = f"  nat {entry.natural}/d{entry.die}" if entry.natural else ""
+            expression = entry.expression.rstrip(b"\0").decode("utf-8", "replace")
+            lines.append(f"{datetime.fromtimestamp(entry.time):%m-%d %H:%M}  {name[:16]:<16} {entry.total:>5}{natural:<13}  {expression}")
+        return "```\n" + "\n".join(lines) + "\n```"
+
+    async def _get_luck(self, guild: str, author: str, fields: list) -> str:
+        user = await self._find_user(guild, author, fields[1]) if len(fields) > 1 else author
+        if user is None:
+            return f"Nobody named {fields[1]} rolled here."
+
+        history = await self.history.get(guild)
+        number = int(user) if user.isdigit() else 0
+        luck = describe_luck(history.luck.get(number, {}))
+        if not luck:
+            return "No dice rolled yet."
+        name = self.cache[guild]["users"][user]["name"]
+        rolls = history.rolls.get(number, 0)
+        return f"Dice rolled by {name} over their last {rolls} rolls here, counting the first dice of each roll:\n```\n{luck}\n```"
+
+    async def _find_user(self, guild: str, author: str, name: str) -> str:
+        # Users are named by their display name, or "me"
+        if name == "me":
+            return author
+        return next((user for user, profile in self.cache[guild]["users"].items() if profile["name"].lower() == name), None)
+
+    async def _get_distance(self, guild: str, author: str, fields: list) -> str:
+        if len(fields) != 4:
+            return "Received too few or too many arguments, please check the help command for instructions."
+
+        x = int(fields[1])
+        y = int(fields[2])
+        d = int(fields[3])
+
+        if x and y and d:
+            return "So you already know all three sides? Why are you asking me then? Kids these days..."
+        if x and y:
+            d = math.ceil(math.sqrt(math.pow(x, 2) + math.pow(y, 2)) / 5) * 5
+            return f"Moving `{x}ft` on the ground and `{y}ft` vertically costs `{d}ft` of total movement."
+        if x and d:
+            y = math.floor(math.sqrt(math.pow(d, 2) - math.pow(x, 2)) / 5) * 5
+            return f"Moving `{d}ft` diagonally and `{x}ft` on the ground allows you to move `{y}ft` vertically."
+        if y and d:
+            x = math.floor(math.sqrt(math.pow(d, 2) - math.pow(y, 2)) / 5) * 5
+            return f"Moving `{d}ft` diagonally and `{y}ft` vertically allows you to move `{x}ft` on the ground."
+        return "I need to know the length of two sides to calculate the third, I'm not a wizard..."
+
+    async def _get_fall_time(self, guild: str, author: str, fields: list) -> str:
+        if len(fields) != 2:
+            return "Received too few or too many arguments, please check the help command for instructions."
+
+        height = int(fields[1])
+        if height < 500:
+            time = round(math.sqrt(height * 36 / 500.0), 2)
+        else:
+            time = round(height * 6 / 500.0, 2)
+        rounds = round(time / 6, 2)
+        return f"Falling from `{height}ft` high will take `{time}s` to hit the ground, or `{rounds}` rounds."
 
-        try:
-            with open(f"{config['General']['Storage']}/cache.json", "rt", encoding="utf-8") as fd:
-                self.cache = json.load(fd)
-        except FileNotFoundError:
-            self.cache = {}
-
-        self.stats = ["str", "dex", "con", "int", "wis", "cha"]
-        self.skills = [
-            "acrobatics",
-            "animal_handling",
-            "arcana",
-            "athletics",
-            "deception",
-            "history",
-            "insight",
-            "intimidation",
-            "investigation",
-            "medicine",
-            "nature",
-            "perception",
-            "performance",
-            "persuasion",
-            "religion",
-            "sleight_of_hand",
-            "stealth",
-            "survival",
-        ]
+    async def _get_help(self, guild: str, author: str, fields: list) -> list:
+        return [strings.HELP_MSG_1, strings.HELP_MSG_2, strings.SESSION_HELP, strings.INIT_HELP]
 
-    async def on_ready(self):
-        """Called when the app is ready"""
-        logging.info("Logged on as {0}!".format(self.user))
+    async def _get_metrics(self, guild: str, author: str, fields: list) -> str:
+        if author not in self.admins:
+            return "Only the bot admins can see its metrics."
+        return f"```\n{self._report_metrics()[:1980]}\n```"
 
-    async def on_message(self, message: Message):
-        """Called when a message is received by the app"""
-        # Filter out normal messages
-        if message.content.startswith("!"):
+    async def _write_metrics(self) -> None:
+        while True:
+            await asyncio.sleep(self.metrics_interval)
             try:
-                if message.guild:
-                    guild = str(message.guild.id)
-                else:
-                    guild = "None"
-
-                # Ensure the cache is initialized for the author
-                author = f"{str(message.author.id)}"
-                self.cache.setdefault(guild, {})
-                self.cache[guild].setdefault("users", {})
-                self.cache[guild].setdefault("sessions", {})
-                self.cache[guild]["sessions"].setdefault("on", [])
-                self.cache[guild]["sessions"].setdefault("off", [])
-                self.cache[guild]["sessions"].setdefault("wday", -1)
-                self.cache[guild]["users"].setdefault(author, {})
-                self.cache[guild]["users"][author]["name"] = str(message.author.display_name)
-                self.cache[guild]["users"][author].setdefault("characters", {})
-                self.cache[guild]["users"][author].setdefault("unavailability", [])
-                self.cache[guild]["users"][author].setdefault("active", "")
-                fields = message.content.lower().split(" ")
-                summary = ""
-
-                # Process roll commands
-                if fields[0] == "!r" or fields[0] == "!roll":
-                    # If the character is missing from the roll command, add the active one
-                    if fields[1] not in self.cache[guild]["users"][author]["characters"].keys():
-                        if self.cache[guild]["users"][author]["active"] in self.cache[guild]["users"][author]["characters"]:
-                            fields = fields[:1] + [self.cache[guild]["users"][author]["active"]] + fields[1:]
-                        else:
-                            fields = fields[:1] + ["You"] + fields[1:]
-
-                    # Check if a character was passed to roll a stat/skill check or save
-                    character = self.cache[guild]["users"][author]["characters"].get(fields[1], await self._create_empty_character())
-                    modifiers = {
-                        "mode": "n",
-                        "save": False,
-                        "crit": False,
-                        "vars": [],
-                    }
-
-                    try:
-                        roll = d20.roll(await self._resolve_references(character, fields[2]))
-                    except d20.RollError:
-                        for field in fields[3:]:
-                            if field == "save":
-                                modifiers["save"] = True
-                            elif field in ["crit", "critical"]:
-                                modifiers["crit"] = True
-                            elif field in ["a", "adv", "advantage"]:
-                                modifiers["mode"] = "a"
-                            elif field in ["ta", "tadv", "tadvantage"]:
-                                modifiers["mode"] = "ta"
-                            elif field in ["d", "dis", "disadvantage"]:
-                                modifiers["mode"] = "d"
-                            elif field in character["variables"].keys():
-                                modifiers["vars"].append(field)
-
-                        roll = d20.roll(await self._get_character_roll(character, fields[2], modifiers))
-
-                    summary = f"{await self._generate_roll_summary(fields[1], fields[2], modifiers, character['macros'])}:\n"
-                    await message.channel.send(f"{summary}{str(roll)}")
-
-                # Process character commands
-                elif fields[0] == "!character" or fields[0] == "!char" or fields[0] == "!c":
-                    # Send character help if requested or no option selected
-                    if len(fields) == 1 or fields[1] == "help" or fields[1] == "h":
-                        await message.channel.send(strings.CHAR_HELP)
-
-                    # Process create character command
-                    elif fields[1] == "create" or fields[1] == "c":
-                        await message.channel.send(await self._create_character(guild, author, fields))
-
-                    # Process delete character command
-                    elif fields[1] == "delete" or fields[1] == "d":
-                        await message.channel.send(await self._delete_character(guild, author, fields))
-
-                    # Process update character command
-                    elif fields[1] == "update" or fields[1] == "u":
-                        await message.channel.send(await self._update_character(guild, author, fields))
-
-                    # Process active character command
-                    elif fields[1] == "active" or fields[1] == "a":
-                        if len(fields) == 2:
-                            await message.channel.send(
-                                f"You current active character is {self.cache[guild]['users'][author]['active'].capitalize()}."
-                            )
-                        elif fields[2] in self.cache[guild]["users"][author]["characters"].keys():
-                            self.cache[guild]["users"][author]["active"] = fields[2]
-                            await message.channel.send(f"{fields[2].capitalize()} set as the active character.")
-                        else:
-                            await message.channel.send("No such character exists for you.")
-
-                    # Process info character command
-                    elif fields[1] == "info" or fields[1] == "show" or fields[1] == "i" or fields[1] == "s":
-                        await message.channel.send(await self._get_character(guild, author, fields))
-
-                    # Process info character command
-                    elif fields[1] == "list" or fields[1] == "l":
-                        characters = [c.capitalize() for c in self.cache[guild]["users"][author]["characters"].keys()]
-                        await message.channel.send(f"Your characters are: {characters}.")
-
-                # Process macro commands
-                elif fields[0] == "!m" or fields[0] == "!macro":
-                    # Send character help if requested or no option selected
-                    if len(fields) == 1 or fields[1] == "help" or fields[1] == "h":
-                        await message.channel.send(strings.VARS_HELP)
-
-                    # Add the active character if missing from a 2 parameter command
-                    if len(fields) == 2:
-                        fields.append(self.cache[guild]["users"][author]["active"])
-
-                    # If the character is missing from the macro command, add the active one
-                    if fields[2] not in self.cache[guild]["users"][author]["characters"].keys():
-                        fields = fields[:2] + [self.cache[guild]["users"][author]["active"]] + fields[2:]
-
-                    # Process set macro command
-                    if fields[1] == "set" or fields[1] == "s":
-                        await message.channel.send(await self._set_macro(guild, author, fields))
-
-                    # Process delete macro command
-                    elif fields[1] == "delete" or fields[1] == "d":
-                        await message.channel.send(await self._delete_macro(guild, author, fields))
-
-                    # Process list macro command
-                    elif fields[1] == "list" or fields[1] == "l":
-                        await message.channel.send(await self._get_macros(guild, author, fields))
-
-                # Process vars commands
-                elif fields[0] == "!v" or fields[0] == "!var" or fields[0] == "!variable":
-                    # Send character help if requested or no option selected
-                    if len(fields) == 1 or fields[1] == "help" or fields[1] == "h":
-                        await message.channel.send(strings.VARS_HELP)
-
-                    # Add the active character if missing from a 2 parameter command
-                    if len(fields) == 2:
-                        fields.append(self.cache[guild]["users"][author]["active"])
-
-                    # If the character is missing from the macro command, add the active one
-                    if fields[2] not in self.cache[guild]["users"][author]["characters"].keys():
-                        fields = fields[:2] + [self.cache[guild]["users"][author]["active"]] + fields[2:]
-
-                    # Process set variable command
-                    if fields[1] == "set" or fields[1] == "s":
-                        await message.channel.send(await self._set_variable(guild, author, fields))
-
-                    # Process delete variable command
-                    elif fields[1] == "delete" or fields[1] == "h":
-                        await message.channel.send(await self._delete_variable(guild, author, fields))
-
-                    # Process list variable command
-                    elif fields[1] == "list" or fields[1] == "l":
-                        await message.channel.send(await self._get_variables(guild, author, fields))
-
-                # Process session commands
-                elif fields[0] == "!session" or fields[0] == "!s":
-                    await self._clean_sessions(guild)
-
-                    # Send character help if requested or no option selected
-                    if len(fields) == 1 or fields[1] == "help" or fields[1] == "h":
-                        await message.channel.send(strings.SESSION_HELP)
-
-                    elif fields[1] == "weekday" or fields[1] == "w":
-                        day = [x.lower() for x in list(calendar.day_name)].index(fields[2].lower())
-                        self.cache[guild]["sessions"]["wday"] = day
-                        await message.channel.send(f"Default session weekday set to {calendar.day_name[self.cache[guild]['sessions']['wday']]}.")
-
-                    elif fields[1] == "schedule" or fields[1] == "s":
-                        date = parse(fields[2])
-                        if date.date() >= date.now().date():
-                            datestr = date.strftime("%Y-%m-%d")
-                            if datestr in self.cache[guild]["sessions"]["on"] or (
-                                date.weekday() == self.cache[guild]["sessions"]["wday"] and datestr not in self.cache[guild]["sessions"]["off"]
-                            ):
-                                await message.channel.send("We already have a session on that day.")
-                            else:
-                                if date.weekday() != self.cache[guild]["sessions"]["wday"]:
-                                    self.cache[guild]["sessions"]["on"].append(datestr)
-
-                                if datestr in self.cache[guild]["sessions"]["off"]:
-                                    self.cache[guild]["sessions"]["off"].remove(datestr)
-
-                                await message.channel.send(f"Session scheduled to {datestr} :tada:")
-                        else:
-                            await message.channel.send("I'm also eager, but even I cannot go back in time.")
-
-                    elif fields[1] == "cancel" or fields[1] == "c":
-                        date = parse(fields[2])
-                        datestr = date.strftime("%Y-%m-%d")
-                        if datestr in self.cache[guild]["sessions"]["on"]:
-                            self.cache[guild]["sessions"]["on"].remove(datestr)
-                            await message.channel.send("Extra session cancelled.")
-                        elif date.weekday() == self.cache[guild]["sessions"]["wday"]:
-                            if datestr not in self.cache[guild]["sessions"]["off"]:
-                                self.cache[guild]["sessions"]["off"].append(datestr)
-                                await message.channel.send("Sunday session cancelled.")
-                            else:
-                                await message.channel.send("This Sunday session was already cancelled.")
-                        else:
-                            await message.channel.send("Could not find an extra session scheduled for that date.")
-
-                    elif fields[1] == "available" or fields[1] == "a":
-                        date = parse(fields[2])
-                        datestr = date.strftime("%Y-%m-%d")
-                        if datestr in self.cache[guild]["sessions"]["on"] or date.weekday() == self.cache[guild]["sessions"]["wday"]:
-                            if datestr in self.cache[guild]["users"][author]["unavailability"]:
-                                self.cache[guild]["users"][author]["unavailability"].remove(datestr)
-                                await message.channel.send("Glad to see you can make it!")
-                            else:
-                                await message.channel.send("Didn't know you couldn't make it, but I'm glad to see you can make it!")
-                        else:
-                            await message.channel.send("I do not recall a session scheduled for that day.")
-
-                    elif fields[1] == "unavailable" or fields[1] == "u":
-                        date = parse(fields[2])
-                        datestr = date.strftime("%Y-%m-%d")
-                        if datestr in self.cache[guild]["sessions"]["on"] or date.weekday() == self.cache[guild]["sessions"]["wday"]:
-                            if datestr not in self.cache[guild]["users"][author]["unavailability"]:
-                                self.cache[guild]["users"][author]["unavailability"].append(datestr)
-                                await message.channel.send("If we play, we'll try not to kill your character.")
-                            else:
-                                await message.channel.send("We know :(")
-                        else:
-                            await message.channel.send("I do not recall a session scheduled for that day.")
-
-                    elif fields[1] == "list" or fields[1] == "l":
-                        await message.channel.send("Next four scheduled sessions:")
-
-                        reported = 0
-                        date = datetime.now()
-                        while reported != 4:
-                            datestr = date.strftime("%Y-%m-%d")
-                            if (
-                                date.weekday() == self.cache[guild]["sessions"]["wday"] and datestr not in self.cache[guild]["sessions"]["off"]
-                            ) or datestr in self.cache[guild]["sessions"]["on"]:
-                                await message.channel.send(
-                                    f"""**{datestr}** - Missing players: {[
-                                        self.cache[guild]['users'][u]['name']
-                                        for u in self.cache[guild]['users'].keys()
-                                        if datestr in self.cache[guild]['users'][u]['unavailability']
-                                    ]}"""
-                                )
-                                reported = reported + 1
-                            date += timedelta(days=1)
-
-                    elif fields[1] == "next" or fields[1] == "n":
-                        await message.channel.send("Next scheduled session:")
-
-                        reported = False
-                        date = datetime.now()
-                        while not reported:
-                            datestr = date.strftime("%Y-%m-%d")
-                            if (
-                                date.weekday() == self.cache[guild]["sessions"]["wday"] and datestr not in self.cache[guild]["sessions"]["off"]
-                            ) or datestr in self.cache[guild]["sessions"]["on"]:
-                                await message.channel.send(
-                                    f"""**{datestr}** - Missing players: {[
-                                        self.cache[guild]['users'][u]['name']
-                                        for u in self.cache[guild]['users'].keys()
-                                        if datestr in self.cache[guild]['users'][u]['unavailability']
-                                    ]}"""
-                                )
-                                reported = True
-                            date += timedelta(days=1)
-
-                elif fields[0] == "!distance" or fields[0] == "!d":
-                    if len(fields) == 4:
-                        x = int(fields[1])
-                        y = int(fields[2])
-                        d = int(fields[3])
-
-                        if x and y and d:
-                            await message.channel.send("So you already know all three sides? Why are you asking me then? Kids these days...")
-                        elif x and y:
-                            d = math.ceil(math.sqrt(math.pow(x, 2) + math.pow(y, 2)) / 5) * 5
-                            await message.channel.send(f"Moving `{x}ft` on the ground and `{y}ft` vertically costs `{d}ft` of total movement.")
-                        elif x and d:
-                            y = math.floor(math.sqrt(math.pow(d, 2) - math.pow(x, 2)) / 5) * 5
-                            await message.channel.send(f"Moving `{d}ft` diagonally and `{x}ft` on the ground allows you to move `{y}ft` vertically.")
-                        elif y and d:
-                            x = math.floor(math.sqrt(math.pow(d, 2) - math.pow(y, 2)) / 5) * 5
-                            await message.channel.send(f"Moving `{d}ft` diagonally and `{y}ft` vertically allows you to move `{x}ft` on the ground.")
-                        else:
-                            await message.channel.send("I need to know the length of two sides to calculate the third, I'm not a wizard...")
-                    else:
-                        await message.channel.send("Received too few or too many arguments, please check the help command for instructions.")
-
-                elif fields[0] == "!fall" or fields[0] == "!f":
-                    if len(fields) == 2:
-                        height = int(fields[1])
-                        if height < 500:
-                            time = round(math.sqrt(height * 36 / 500.0), 2)
-                        else:
-                            time = round(height * 6 / 500.0, 2)
-                        rounds = round(time / 6, 2)
-                        await message.channel.send(f"Falling from `{height}ft` high will take `{time}s` to hit the ground, or `{rounds}` rounds.")
-                    else:
-                        await message.channel.send("Received too few or too many arguments, please check the help command for instructions.")
-
-                # Process help command
-                elif fields[0] == "!h" or fields[0] == "!help":
-                    await message.channel.send(strings.HELP_MSG_1)
-                    await message.channel.send(strings.HELP_MSG_2)
-                    await message.channel.send(strings.SESSION_HELP)
-            except Exception as ex:
+                await asyncio.to_thread(self.metrics.write, self.metrics_file, self._report_metrics())
+            except OSError as ex:
                 logging.exception(ex)
-            finally:
-                with open(f"{config['General']['Storage']}/cache.json", "wt", encoding="utf-8") as fd:
-                    json.dump(self.cache, fd)
 
-    async def _clean_sessions(self, guild: str) -> None:
+    def _report_metrics(self) -> str:
+        # The caches and the storage count on their own, so their totals are copied in whenever a report is made
+        self.metrics.count("expression cache hits", self.expressions.hits)
+        self.metrics.count("expression cache misses", self.expressions.misses)
+        self.metrics.count("odds cache hits", self.odds.hits)
+        self.metrics.count("odds cache misses", self.odds.misses)
+        self.metrics.count("guild loads", self.storage.loads)
+        self.metrics.count("guild evictions", self.storage.evictions)
+        self.metrics.gauge("resident guilds", self.storage.resident)
+        return self.metrics.report()
+
+    async def _clean_sessions(self, guild: str, author: str, fields: list) -> list:
         now = datetime.now().strftime("%Y-%m-%d")
 
-        for session in [s for s in self.cache[guild]["sessions"]["on"] if s < now]:
-            self.cache[guild]["sessions"]["on"].remove(session)
-
-        for session in [s for s in self.cache[guild]["sessions"]["off"] if s < now]:
-            self.cache[guild]["sessions"]["off"].remove(session)
+        for kind in ["on", "off"]:
+            if any(s < now for s in self.cache[guild]["sessions"][kind]):
+                self.storage.set([guild, "sessions", kind], [s for s in self.cache[guild]["sessions"][kind] if s >= now])
 
         for user in self.cache[guild]["users"]:
-            for session in [s for s in self.cache[guild]["users"][user]["unavailability"] if s < now]:
-                self.cache[guild]["users"][user]["unavailability"].remove(session)
+            if any(s < now for s in self.cache[guild]["users"][user]["unavailability"]):
+                self.storage.set(
+                    [guild, "users", user, "unavailability"], [s for s in self.cache[guild]["users"][user]["unavailability"] if s >= now]
+                )
+        return fields
+
+    async def _get_sessions(self, guild: str, count: int) -> list:
+        index = self._get_session_index(guild)
+        users = self.cache[guild]["users"]
+
+        dates = index.upcoming(datetime.now().date(), count)
+        if not dates:
+            return ["No sessions are scheduled."]
+        return [f"**{datestr}** - Missing players: {[users[u]['name'] for u in index.missing(datestr) if u in users]}" for datestr in dates]
+
+    def _get_session_index(self, guild: str) -> SessionIndex:
+        # Entries hold the guild data they were built from, so a reloaded guild is reindexed
+        entry = self._sessions.get(guild)
+        if entry is not None and entry[0] is self.cache[guild]:
+            self._sessions.move_to_end(guild)
+            return entry[1]
+
+        index = SessionIndex(self.cache[guild]["sessions"], self.cache[guild]["users"])
+        self._sessions[guild] = (self.cache[guild], index)
+        self._sessions.move_to_end(guild)
+        if len(self._sessions) > self.storage.max_guilds:
+            self._sessions.popitem(last=False)
+        return index
 
     async def _create_character(self, guild: str, author: str, fields: list) -> str:
         try:
@@ -435,157 +782,189 @@ class DNDRoller(discord.Client):
                     return f"Error: unknown skill {fields[idx]}."
                 idx = idx + 1
 
-            self.cache[guild]["users"][author]["characters"][name] = character
-            self.cache[guild]["users"][author]["active"] = name
+            error = check_scores(character["level"], list(character["stats"].values()))
+            if error:
+                return error
+
+            self._forget(self.cache[guild]["users"][author]["characters"].get(name))
+            created = Character.from_json(character)
+            self.storage.set([guild, "users", author, "characters", name], created)
+            if (guild, author) in self._names:
+                self._names[(guild, author)].add_character(name, created)
+            self.storage.set([guild, "users", author, "active"], name)
             return f"Character {name} created and set as default."
         except Exception:
             return "Could not create the character, use !help for help."
 
     async def _delete_character(self, guild: str, author: str, fields: list) -> str:
-        if self.cache[guild]["users"][author]["characters"].pop(fields[2], None):
+        if fields[2] in self.cache[guild]["users"][author]["characters"]:
+            self._forget(self.cache[guild]["users"][author]["characters"][fields[2]])
+            self.storage.delete([guild, "users", author, "characters", fields[2]])
+            if (guild, author) in self._names:
+                self._names[(guild, author)].remove_character(fields[2])
             return f"Removed character {fields[2].capitalize()}. You may need to set a new active character."
         return "No such character exists for you."
 
     async def _update_character(self, guild: str, author: str, fields: list) -> str:
-        if fields[2] in self.cache[guild]["users"][author]["characters"].keys():
-            character = self.cache[guild]["users"][author]["characters"][fields[2]]
-            idx = 4
-
-            if fields[3] == "main":
-                character["level"] = int(fields[4])
-                character["stats"] = {
-                    "str": int(fields[5]),
-                    "dex": int(fields[6]),
-                    "con": int(fields[7]),
-                    "int": int(fields[8]),
-                    "wis": int(fields[9]),
-                    "cha": int(fields[10]),
-                }
-
-            elif fields[3] == "saves":
-                character["save_prof"].clear()
-                while idx < len(fields):
-                    if fields[idx] in self.stats:
-                        character["save_prof"].append(fields[idx])
-                    else:
-                        return f"Error: unknown stat {fields[idx]}."
-                    idx = idx + 1
-
-            elif fields[3] == "bonus":
-                if len(fields) == 6:
-                    character["ability_bonus"] = int(fields[4])
-                    character["skill_bonus"] = int(fields[5])
-                else:
-                    return "Error: Wrong number of arguments. Expected general save and check bonus."
-
-            elif fields[3] == "skills":
-                character["skill_prof"].clear()
-                while idx < len(fields):
-                    if fields[idx] in self.skills:
-                        character["skill_prof"].append(fields[idx])
-                    else:
-                        return f"Error: unknown skill {fields[idx]}."
-                    idx = idx + 1
-
-            elif fields[3] == "expertise":
-                character["skill_expertise"].clear()
-                while idx < len(fields):
-                    if fields[idx] in self.skills:
-                        character["skill_expertise"].append(fields[idx])
-                    else:
-                        return f"Error: unknown skill {fields[idx]}."
-                    idx = idx + 1
-
-            elif fields[3] == "adv" or fields[3] == "advantage":
-                character["advantage"] = character.get("advantage", [])
-                character["advantage"].clear()
-                while idx < len(fields):
-                    target = await self._get_stat_shortname(fields[idx])
-                    if target in (self.skills + self.stats):
-                        character["advantage"].append(target)
-                    else:
-                        return f"Error: unknown ability/skill {fields[idx]}."
-                    idx = idx + 1
-
-            self.cache[guild]["users"][author]["characters"][fields[2]] = character
-            return f"Character {fields[2]} was updated."
-        return "No such character exists for you."
+        if fields[2] not in self.cache[guild]["users"][author]["characters"].keys():
+            return "No such character exists for you."
+
+        # Validate the whole update before changing anything, so a bad field never leaves a half-updated character
+        changes, error = await self._get_character_update(fields)
+        if error:
+            return error
 
-    async def _set_macro(self, guild: str, author: str, fields: list) -> str:
         character = self.cache[guild]["users"][author]["characters"][fields[2]]
-        character["macros"][fields[3]] = fields[4]
+        self._forget(character)
+        self.storage.set([guild, "users", author, "characters", fields[2]], Character.from_json({**character.to_json(), **changes}))
+        return f"Character {fields[2]} was updated."
+
+    async def _get_character_update(self, fields: list) -> tuple[dict, str]:
+        if fields[3] == "main":
+            if len(fields) != 11 or not all(field.lstrip("-").isdigit() for field in fields[4:]):
+                return {}, "Error: Expected a level and the six ability scores."
+            level, scores = int(fields[4]), [int(field) for field in fields[5:]]
+            error = check_scores(level, scores)
+            if error:
+                return {}, error
+            return {"level": level, "stats": dict(zip(STATS, scores))}, ""
+
+        if fields[3] == "saves":
+            for field in fields[4:]:
+                if field not in self.stats:
+                    return {}, f"Error: unknown stat {field}."
+            return {"save_prof": fields[4:]}, ""
+
+        if fields[3] == "bonus":
+            if len(fields) != 6 or not all(field.lstrip("-").isdigit() for field in fields[4:]):
+                return {}, "Error: Wrong number of arguments. Expected general save and check bonus."
+            return {"ability_bonus": int(fields[4]), "skill_bonus": int(fields[5])}, ""
+
+        if fields[3] in ["skills", "expertise"]:
+            for field in fields[4:]:
+                if field not in self.skills:
+                    return {}, f"Error: unknown skill {field}."
+            return {"skill_prof" if fields[3] == "skills" else "skill_expertise": fields[4:]}, ""
+
+        if fields[3] == "adv" or fields[3] == "advantage":
+            advantage = []
+            for field in fields[4:]:
+                target = await self._get_stat_shortname(field)
+                if target not in ABILITY_BITS:
+                    return {}, f"Error: unknown ability/skill {field}."
+                advantage.append(target)
+            return {"advantage": advantage}, ""
+
+        return {}, ""
+
+    async def _set_macro(self, guild: str, author: str, fields: list) -> str:
+        if fields[2] not in self.cache[guild]["users"][author]["characters"]:
+            return "No such character exists for you."
+        self._forget(self.cache[guild]["users"][author]["characters"][fields[2]])
+        self.storage.set([guild, "users", author, "characters", fields[2], "macros", fields[3]], fields[4])
+        if (guild, author) in self._names:
+            self._names[(guild, author)].of("macros", fields[2]).add(fields[3])
         return f"Added macro {fields[3]} to {fields[2].capitalize()}."
 
     async def _delete_macro(self, guild: str, author: str, fields: list) -> str:
         character = self.cache[guild]["users"][author]["characters"][fields[2]]
-        if character["macros"].pop(fields[3], None):
+        if fields[3] in character.macros:
+            self._forget(character)
+            self.storage.delete([guild, "users", author, "characters", fields[2], "macros", fields[3]])
+            if (guild, author) in self._names:
+                self._names[(guild, author)].of("macros", fields[2]).remove(fields[3])
             return f"Removed macro {fields[3]} from {fields[2].capitalize()}."
         return f"No such macro exists on {fields[2].capitalize()}."
 
     async def _get_macros(self, guild: str, author: str, fields: list) -> str:
-        character = self.cache[guild]["users"][author]["characters"][fields[2]]
-        macros = [f"{m}[{character['macros'][m]}]" for m in character["macros"].keys()]
-        return f"{fields[2].capitalize()} has the following macros: {macros}."
+        return self._get_rendered(self.cache[guild]["users"][author]["characters"][fields[2]], "macros", fields[2], self._render_macros)
 
     async def _set_variable(self, guild: str, author: str, fields: list) -> str:
-        character = self.cache[guild]["users"][author]["characters"][fields[2]]
-        character["variables"][fields[3]] = fields[4]
+        if fields[2] not in self.cache[guild]["users"][author]["characters"]:
+            return "No such character exists for you."
+        self._forget(self.cache[guild]["users"][author]["characters"][fields[2]])
+        self.storage.set([guild, "users", author, "characters", fields[2], "variables", fields[3]], fields[4])
+        if (guild, author) in self._names:
+            self._names[(guild, author)].of("variables", fields[2]).add(fields[3])
         return f"Added variable {fields[3]} to {fields[2].capitalize()}."
 
     async def _delete_variable(self, guild: str, author: str, fields: list) -> str:
         character = self.cache[guild]["users"][author]["characters"][fields[2]]
-        if character["variables"].pop(fields[3], None):
+        if fields[3] in character.variables:
+            self._forget(character)
+            self.storage.delete([guild, "users", author, "characters", fields[2], "variables", fields[3]])
+            if (guild, author) in self._names:
+                self._names[(guild, author)].of("variables", fields[2]).remove(fields[3])
             return f"Removed variable {fields[3]} from {fields[2].capitalize()}."
         return f"No such variable exists on {fields[2].capitalize()}."
 
     async def _get_variables(self, guild: str, author: str, fields: list) -> str:
-        character = self.cache[guild]["users"][author]["characters"][fields[2]]
-        variables = [f"{v}[{character['variables'][v]}]" for v in character["variables"].keys()]
-        return f"{fields[2].capitalize()} has the following variables: {variables}."
+        return self._get_rendered(self.cache[guild]["users"][author]["characters"][fields[2]], "variables", fields[2], self._render_variables)
 
     async def _get_character(self, guild: str, author: str, fields: list) -> str:
-        msg = "```\n"
         if len(fields) > 2 and fields[2] in self.cache[guild]["users"][author]["characters"].keys():
             name = fields[2]
         else:
             name = self.cache[guild]["users"][author]["active"]
 
-        character = self.cache[guild]["users"][author]["characters"][name]
-        prof_mod = await self._get_character_prof_mod(character)
-
-        msg = f"{msg}Name: {name.capitalize()}\n"
-        msg = f"{msg}Level: {character['level']}\n"
-        msg = f"{msg}Proficiency: {prof_mod}\n"
-        msg = f"{msg}Ability Check Bonus: {character.get('ability_bonus', 0)}\n"
-        msg = f"{msg}Skill Check Bonus: {character.get('skill_bonus', 0)}\n"
-
-        msg = msg + "\n"
+        return self._get_rendered(self.cache[guild]["users"][author]["characters"][name], "sheet", name, self._render_sheet)
+
+    def _render_sheet(self, character: Character, name: str) -> str:
+        derived = self._get_derived_stats(character)
+        lines = [
+            "```",
+            f"Name: {name.capitalize()}",
+            f"Level: {character.level}",
+            f"Proficiency: {derived.prof}",
+            f"Ability Check Bonus: {character.ability_bonus}",
+            f"Skill Check Bonus: {character.skill_bonus}",
+            "",
+        ]
 
         for stat in self.stats:
-            fullstat = await self._get_stat_fullname(stat)
-            score = character["stats"][stat]
-            mod = await self._get_character_stat_mod(character, stat) + character.get("ability_bonus", 0)
-            if stat in character["save_prof"]:
-                fstr = "%15s: %2s (%s/%s) ✓" % (fullstat.capitalize(), score, mod, mod + prof_mod)
-                msg = f"{msg}{fstr}\n"
-            else:
-                fstr = "%15s: %2s (%s/%s)" % (fullstat.capitalize(), score, mod, mod)
-                msg = f"{msg}{fstr}\n"
-
-        msg = msg + "\n"
+            mod, save = derived.stat_mods[stat] + character.ability_bonus, derived.save_mods[stat] + character.ability_bonus
+            mark = " ✓" if character.proficient_save(stat) else ""
+            lines.append("%15s: %2s (%s/%s)%s" % (STAT_NAMES[stat].capitalize(), derived.scores[stat], mod, save, mark))
+        lines.append("")
 
         for skill in self.skills:
-            stat = await self._get_skill_stat(skill)
             pretty_skill = " ".join(skill.split("_")).title()
-            mod, prof_indicator = await self._get_character_skill_mod(character, skill)
-            mod = mod + character.get("skill_bonus", 0)
-            adv_mod = 5 if await self._get_stat_shortname(skill) in character.get("advantage", []) else 0
-            fstr = "%15s: %2s (%s|%s) %s" % (pretty_skill, mod, stat, 10 + mod + adv_mod, prof_indicator)
-            msg = f"{msg}{fstr}\n"
-
-        msg = msg + "```"
-
-        return msg
+            mod = derived.skill_mods[skill] + character.skill_bonus
+            adv_mod = 5 if character.has_advantage(skill) else 0
+            lines.append("%15s: %2s (%s|%s) %s" % (pretty_skill, mod, SKILL_STATS[skill], 10 + mod + adv_mod, derived.skill_marks[skill]))
+        lines.append("```")
+
+        return "\n".join(lines)
+
+    @staticmethod
+    def _render_macros(character: Character, name: str) -> str:
+        macros = [f"{m}[{character.macros[m]}]" for m in character.macros.keys()]
+        return f"{name.capitalize()} has the following macros: {macros}."
+
+    @staticmethod
+    def _render_variables(character: Character, name: str) -> str:
+        variables = [f"{v}[{character.variables[v]}]" for v in character.variables.keys()]
+        return f"{name.capitalize()} has the following variables: {variables}."
+
+    def _get_rendered(self, character: Character, kind: str, name: str, render) -> str:
+        # Entries hold a reference to their character, so its id cannot be reused while cached
+        key = (id(character), kind, name)
+        entry = self._rendered.get(key)
+        if entry is not None:
+            self._rendered.move_to_end(key)
+            return entry[1]
+
+        text = render(character, name)
+        self._rendered[key] = (character, text)
+        if len(self._rendered) > self.rendered_size:
+            self._rendered.popitem(last=False)
+        return text
+
+    def _forget(self, character: Character) -> None:
+        # Drops everything cached for a character that is about to change or go away
+        self._derived.pop(id(character), None)
+        for key in [key for key in self._rendered if key[0] == id(character)]:
+            del self._rendered[key]
 
     async def _get_skill_stat(self, skill: str) -> str:
         if skill in ["int", "intelligence", "arcana", "history", "investigation", "nature", "religion"]:
@@ -606,10 +985,133 @@ class DNDRoller(discord.Client):
     async def _is_ability_stat(self, skill: str) -> bool:
         return skill in ["int", "intelligence", "cha", "charisma", "dex", "dexterity", "str", "strength", "con", "constitution", "wis", "wisdom"]
 
-    async def _get_character_roll(self, character: dict, target: str, modifiers: dict) -> str:
+    async def _prepare_roll(self, guild: str, author: str, fields: list) -> tuple[list, dict, dict, str]:
+        # Rolls, odds and simulations are not exclusive, so slow ones do not hold up the guild; only resolving the
+        # roll against the character takes the lock
+        async with self.storage.lock(guild):
+            return await self._resolve_roll(guild, author, fields)
+
+    async def _resolve_roll(self, guild: str, author: str, fields: list) -> tuple[list, dict, dict, str]:
+        # If the character is missing from the roll command, add the active one
+        if fields[1] not in self.cache[guild]["users"][author]["characters"].keys():
+            if self.cache[guild]["users"][author]["active"] in self.cache[guild]["users"][author]["characters"]:
+                fields = fields[:1] + [self.cache[guild]["users"][author]["active"]] + fields[1:]
+            else:
+                fields = fields[:1] + ["You"] + fields[1:]
+
+        # Check if a character was passed to roll a stat/skill check or save
+        character = self.cache[guild]["users"][author]["characters"].get(fields[1], EMPTY_CHARACTER)
+        modifiers = {
+            "mode": "n",
+            "save": False,
+            "crit": False,
+            "vars": [],
+        }
+
+        # Only try dice notation when the target is not a known stat, skill or macro
+        if classify_target(fields[2], character.macros, self.vocabulary) == DICE:
+            expression = await self._resolve_references(character, fields[2])
+            try:
+                self.expressions.parse(expression)
+                return fields, character, modifiers, expression
+            except d20.RollError:
+                pass
+
+        for field in fields[3:]:
+            if field == "save":
+                modifiers["save"] = True
+            elif field in ["crit", "critical"]:
+                modifiers["crit"] = True
+            elif field in ["a", "adv", "advantage"]:
+                modifiers["mode"] = "a"
+            elif field in ["ta", "tadv", "tadvantage"]:
+                modifiers["mode"] = "ta"
+            elif field in ["d", "dis", "disadvantage"]:
+                modifiers["mode"] = "d"
+            elif field in character.variables.keys():
+                modifiers["vars"].append(field)
+
+        return fields, character, modifiers, await self._get_character_roll(character, fields[2], modifiers)
+
+    async def _get_odds(self, guild: str, author: str, fields: list) -> str:
+        if "vs" not in fields or fields.index("vs") < 2 or fields.index("vs") != len(fields) - 2:
+            return "Error: Expected '!odds <expression|skill> [a|d] [vars] vs <DC>'."
+
+        if not fields[-1].lstrip("-").isdigit():
+            return "Error: The DC must be a number."
+        dc = int(fields[-1])
+
+        try:
+            fields, character, modifiers, expression = await self._prepare_roll(guild, author, fields[:-2])
+            self.odds.check(self.expressions.parse(expression))
+            dist = self.odds.cached(expression)
+            if dist is None:
+                # Exact odds can take seconds to compute, so they are kept off the threads storage relies on
+                start = perf_counter()
+                dist = await self._run_in_worker(exact_distribution, expression)
+                self.metrics.record("odds offloaded", perf_counter() - start)
+                self.odds.store(expression, dist)
+        except (ResolveError, OddsError, CostError, d20.RollError) as ex:
+            return f"Error: {str(ex).rstrip('.')}."
+        except asyncio.TimeoutError:
+            self.metrics.increment("odds timed out")
+            return f"Error: The odds took longer than {self.roll_timeout:g}s to compute."
+        except BrokenProcessPool:
+            return "Error: Computing the odds crashed its worker."
+
+        summary = await self._generate_roll_summary(fields[1], fields[2], modifiers, character.macros)
+        return f"{summary.replace(' rolled', ' rolling', 1)} vs DC {dc} ({expression}):\n```\n{summarize(dist, dc)}\n```"
+
+    async def _get_bulk_roll(self, guild: str, author: str, fields: list) -> str:
+        index = next(i for i in [1, 2] if re.fullmatch(r"[0-9]+x", fields[i]))
+        count = int(fields[index][:-1])
+        fields = [field for i, field in enumerate(fields) if i != index]
+        if len(fields) < 2:
+            return "Error: Expected '!roll <count>x <expression|skill|macro> [...]'."
+
+        summary, expression, totals = await self._run_simulation(guild, author, fields, count)
+        if totals is None:
+            return summary
+
+        header = f"{summary} {count} times ({expression}):\n"
+        footer = f"```\n{await asyncio.to_thread(describe, totals)}\n```"
+        listing = ", ".join(str(total) for total in totals[:500])
+        if len(header) + len(listing) + len(footer) + 8 > 2000:
+            listing = f"{listing[: 2000 - len(header) - len(footer) - 8].rsplit(', ', 1)[0]}, ..."
+        return f"{header}{listing}\n{footer}"
+
+    async def _get_simulation(self, guild: str, author: str, fields: list) -> str:
+        if len(fields) < 3 or not fields[1].isdigit():
+            return "Error: Expected '!sim <count> <expression|skill|macro> [...]'."
+
+        count = int(fields[1])
+        summary, expression, totals = await self._run_simulation(guild, author, fields[:1] + fields[2:], count)
+        if totals is None:
+            return summary
+        return f"{summary.replace(' rolled', ' simulated', 1)} {count} times ({expression}):\n```\n{await asyncio.to_thread(describe, totals)}\n```"
+
+    async def _run_simulation(self, guild: str, author: str, fields: list, count: int) -> tuple:
+        if count < 1 or count > self.max_simulations:
+            return f"Error: The count must be between 1 and {self.max_simulations}.", None, None
+
+        try:
+            fields, character, modifiers, expression = await self._prepare_roll(guild, author, fields)
+            tree = self.expressions.parse(expression)
+            dice, _ = expression_cost(tree)
+            if count * dice > self.max_simulated_dice:
+                raise CostError(f"rolling {count} times rolls {count * dice} dice, the limit is {self.max_simulated_dice}")
+            totals = await asyncio.to_thread(simulate, tree, count)
+        except (ResolveError, SimulationError, CostError, d20.RollError) as ex:
+            return f"Error: {str(ex).rstrip('.')}.", None, None
+
+        return await self._generate_roll_summary(fields[1], fields[2], modifiers, character.macros), expression, totals
+
+    async def _get_character_roll(self, character: Character, target: str, modifiers: dict) -> str:
+        derived = self._get_derived_stats(character)
+
         # If a macro was passed, roll that instead
-        if target in character["macros"]:
-            roll = await self._resolve_references(character, character["macros"][target])
+        if target in character.macros:
+            roll = await self._resolve_references(character, character.macros[target])
         else:
             # Determine the base die given the roll mode
             roll = "1d20"
@@ -618,31 +1120,31 @@ class DNDRoller(discord.Client):
             stat = await self._get_skill_stat(target)
 
             # Determine stat modifier for the roll
-            roll = f"{roll}+{await self._get_character_stat_mod(character, stat)}"
+            roll = f"{roll}+{derived.stat_mods[stat]}"
 
             # Determine if proficiency applies
-            if (modifiers["save"] and stat in character["save_prof"]) or target in character["skill_prof"]:
-                roll = f"{roll}+{await self._get_character_prof_mod(character)}"
+            if (modifiers["save"] and character.proficient_save(stat)) or character.proficient(target):
+                roll = f"{roll}+{derived.prof}"
 
             # Determine if expertise applies
-            if target in character["skill_expertise"]:
-                roll = f"{roll}+{await self._get_character_prof_mod(character) * 2}"
+            if character.expert(target):
+                roll = f"{roll}+{derived.prof * 2}"
 
         # Add general ability bonus if it is an ability roll
-        if await self._is_ability_stat(target) and character.get("ability_bonus", 0) != 0:
-            roll = f"{roll}+{character['ability_bonus']}"
+        if await self._is_ability_stat(target) and character.ability_bonus != 0:
+            roll = f"{roll}+{character.ability_bonus}"
 
         # Add general skill bonus if it is a skill roll
-        if target in self.skills and character.get("skill_bonus", 0) != 0:
-            roll = f"{roll}+{character['skill_bonus']}"
+        if target in self.skills and character.skill_bonus != 0:
+            roll = f"{roll}+{character.skill_bonus}"
 
         # Add other modifiers
         for var in modifiers["vars"]:
-            roll = f"{roll}+{await self._resolve_references(character, character['variables'][var])}"
+            roll = f"{roll}+{await self._resolve_references(character, character.variables[var])}"
 
         # Set advantage/disadvantage
         if roll.startswith("1d20"):
-            if modifiers["mode"] == "a" or (await self._get_stat_shortname(target)) in character.get("advantage", []):
+            if modifiers["mode"] == "a" or character.has_advantage(await self._get_stat_shortname(target)):
                 roll = roll.replace("1d20", "2d20kh1", 1)
             elif modifiers["mode"] == "ta":
                 roll = roll.replace("1d20", "3d20kh1", 1)
@@ -655,40 +1157,24 @@ class DNDRoller(discord.Client):
 
         return roll
 
-    async def _resolve_references(self, character: dict, value: str) -> str:
-        # Run replace strings
-        value = value.replace("$level", str(character["level"]))
-        value = value.replace("$prof", str(await self._get_character_prof_mod(character)))
-
-        for stat in self.stats:
-            value = value.replace(f"${stat}_mod", str(await self._get_character_stat_mod(character, stat)))
-            value = value.replace(f"${stat}", str(character["stats"][stat]))
-
-        for skill in self.skills:
-            value = value.replace(f"${skill}", str(await self._get_character_skill_mod(character, skill)))
-
-        # Replace variables
-        for var in character["variables"].keys():
-            value = value.replace(f"${var}", str(character["variables"][var]))
-
-        return value
-
-    async def _get_character_stat_mod(self, character: dict, stat: str) -> int:
-        return math.floor(character["stats"][stat] / 2) - 5
-
-    async def _get_character_skill_mod(self, character: dict, skill: str) -> tuple[int, str]:
-        stat = await self._get_skill_stat(skill)
+    async def _resolve_references(self, character: Character, value: str) -> str:
+        return self._get_derived_stats(character).resolver.resolve(value)
 
-        if skill in character["skill_prof"]:
-            return await self._get_character_stat_mod(character, stat) + await self._get_character_prof_mod(character), "✓"
+    def _get_derived_stats(self, character: Character) -> DerivedStats:
+        # Entries hold a reference to their character, so its id cannot be reused while cached
+        entry = self._derived.get(id(character))
+        if entry is not None:
+            self._derived.move_to_end(id(character))
+            return entry[1]
 
-        if skill in character["skill_expertise"]:
-            return await self._get_character_stat_mod(character, stat) + await self._get_character_prof_mod(character) * 2, "✓✓"
+        derived = DerivedStats(character)
+        self._derived[id(character)] = (character, derived)
+        if len(self._derived) > self.derived_size:
+            self._derived.popitem(last=False)
+        return derived
 
-        return await self._get_character_stat_mod(character, stat), ""
-
-    async def _get_character_prof_mod(self, character: dict) -> int:
-        return math.floor((character["level"] - 1) / 4) + 2
+    async def _get_character_stat_mod(self, character: Character, stat: str) -> int:
+        return self._get_derived_stats(character).stat_mods[stat]
 
     async def _generate_roll_summary(self, character: str, target: str, modifiers: dict, macros: dict) -> str:
         summary = f"{character.capitalize()} rolled"
@@ -726,25 +1212,7 @@ class DNDRoller(discord.Client):
         return f"{summary}{mods_str[:-5]}"
 
     async def _get_stat_fullname(self, stat: str) -> str:
-        if stat == "str":
-            stat = "strength"
-
-        if stat == "dex":
-            stat = "dexterity"
-
-        if stat == "con":
-            stat = "constitution"
-
-        if stat == "int":
-            stat = "intelligence"
-
-        if stat == "wis":
-            stat = "wisdom"
-
-        if stat == "cha":
-            stat = "charisma"
-
-        return stat
+        return STAT_NAMES.get(stat, stat)
 
     async def _get_stat_shortname(self, stat: str) -> str:
         if stat == "strength":
@@ -767,29 +1235,151 @@ class DNDRoller(discord.Client):
 
         return stat
 
-    async def _create_empty_character(self) -> dict:
-        return {
-            "level": -7,  # 0 Prof Bonus
-            "stats": {
-                "str": 10,
-                "dex": 10,
-                "con": 10,
-                "int": 10,
-                "wis": 10,
-                "cha": 10,
-            },
-            "save_prof": [],
-            "skill_prof": [],
-            "skill_expertise": [],
-            "advantage": [],
-            "ability_bonus": 0,
-            "skill_bonus": 0,
-            "macros": {},
-            "variables": {},
-        }
+
+class DNDRoller(discord.Client):
+    """Discord Client"""
+
+    def __init__(self, app_intents, settings: configparser.SectionProxy):
+        super().__init__(intents=app_intents)
+        self.engine = CommandEngine(settings)
+        self.outbox = Outbox(self.engine.metrics, settings.getint("SendRetries", 5), settings.getfloat("SendBackoff", 1.0))
+        self.sync_commands = settings.getboolean("SyncCommands", True)
+        self.tree = app_commands.CommandTree(self)
+        self._register_app_commands()
+
+    async def setup_hook(self):
+        """Called before the app connects to Discord"""
+        await self.engine.open()
+        if self.sync_commands:
+            await self.tree.sync()
+
+    async def close(self):
+        """Called when the app is shutting down"""
+        await self.outbox.close()
+        await self.engine.close()
+        await super().close()
+
+    async def on_ready(self):
+        """Called when the app is ready"""
+        logging.info("Logged on as {0}!".format(self.user))
+
+    async def on_message(self, message: Message):
+        """Called when a message is received by the app"""
+        # Filter out normal messages
+        if message.content.startswith("!"):
+            guild = str(message.guild.id) if message.guild else "None"
+            replies = await self.engine.handle(
+                message.content, guild, str(message.author.id), str(message.author.display_name), str(message.channel.id)
+            )
+
+            try:
+                await self.outbox.send(message.channel, replies)
+            except Exception as ex:
+                logging.exception(ex)
+
+    def _register_app_commands(self) -> None:
+        # Slash commands are spelled out as the matching text command and answered by the same engine
+        tree = self.tree
+
+        @tree.command(name="roll", description="Roll dice, or a character's stat, save, skill check or macro")
+        @app_commands.describe(target="Dice, stat, skill or macro", character="One of your characters", options="crit, save, a, ta, d or variables")
+        @app_commands.autocomplete(target=self._complete_target, character=self._complete_character)
+        async def roll(interaction: discord.Interaction, target: str, character: str = "", options: str = ""):
+            await self._answer(interaction, "!roll", character, target, options)
+
+        @tree.command(name="character", description="Manage your characters")
+        @app_commands.describe(name="One of your characters", details="Template for create and update, see /character help")
+        @app_commands.autocomplete(name=self._complete_character)
+        async def character(
+            interaction: discord.Interaction,
+            action: Literal["list", "active", "info", "create", "update", "delete", "help"],
+            name: str = "",
+            details: str = "",
+        ):
+            await self._answer(interaction, "!character", action, name, details)
+
+        @tree.command(name="macro", description="Manage your characters' macros")
+        @app_commands.describe(character="One of your characters", name="Macro name", value="Dice notation")
+        @app_commands.autocomplete(character=self._complete_character, name=self._complete_macro)
+        async def macro(
+            interaction: discord.Interaction, action: Literal["set", "delete", "list", "help"], character: str = "", name: str = "", value: str = ""
+        ):
+            await self._answer(interaction, "!macro", action, character, name, value)
+
+        @tree.command(name="variable", description="Manage your characters' variables")
+        @app_commands.describe(character="One of your characters", name="Variable name", value="Bonus, dice notation or references")
+        @app_commands.autocomplete(character=self._complete_character, name=self._complete_variable)
+        async def variable(
+            interaction: discord.Interaction, action: Literal["set", "delete", "list", "help"], character: str = "", name: str = "", value: str = ""
+        ):
+            await self._answer(interaction, "!variable", action, character, name, value)
+
+        @tree.command(name="session", description="Manage the server's sessions")
+        @app_commands.describe(value="Weekday or YYYY-MM-DD date")
+        @app_commands.autocomplete(value=self._complete_session)
+        async def session(
+            interaction: discord.Interaction,
+            action: Literal["weekday", "schedule", "cancel", "available", "unavailable", "list", "next", "help"],
+            value: str = "",
+        ):
+            await self._answer(interaction, "!session", action, value)
+
+    async def _answer(self, interaction: discord.Interaction, *words: str) -> None:
+        # Rolls may take longer than the 3 seconds Discord gives for the first response
+        await interaction.response.defer()
+        guild = str(interaction.guild_id) if interaction.guild_id else "None"
+        content = " ".join(word for word in words if word)
+        replies = await self.engine.handle(content, guild, str(interaction.user.id), str(interaction.user.display_name), str(interaction.channel_id))
+
+        try:
+            for message in coalesce(replies) or ["Nothing to show."]:
+                await interaction.followup.send(message)
+        except discord.DiscordException as ex:
+            logging.exception(ex)
+
+    async def _complete(self, interaction: discord.Interaction, kind: str, current: str, character: str = "") -> list:
+        guild = str(interaction.guild_id) if interaction.guild_id else "None"
+        names = await self.engine.complete(guild, str(interaction.user.id), kind, current, character)
+        return [app_commands.Choice(name=name, value=name) for name in names]
+
+    async def _complete_character(self, interaction: discord.Interaction, current: str) -> list:
+        return await self._complete(interaction, "character", current)
+
+    async def _complete_target(self, interaction: discord.Interaction, current: str) -> list:
+        return await self._complete(interaction, "target", current, interaction.namespace.character or "")
+
+    async def _complete_macro(self, interaction: discord.Interaction, current: str) -> list:
+        return await self._complete(interaction, "macro", current, interaction.namespace.character or "")
+
+    async def _complete_variable(self, interaction: discord.Interaction, current: str) -> list:
+        return await self._complete(interaction, "variable", current, interaction.namespace.character or "")
+
+    async def _complete_session(self, interaction: discord.Interaction, current: str) -> list:
+        return await self._complete(interaction, "weekday" if interaction.namespace.action == "weekday" else "session", current)
+
+
+def main():
+    """Reads the configuration, sets up logging and runs the bot until it is stopped"""
+    config = configparser.ConfigParser()
+    config.read(f"{os.getenv('HOME', 'root')}/.config/dnd-roller/config.ini")
+
+    log_listener = setup_logging(
+        config["General"].get("LogFile", "/var/log/dnd-roller.log"),
+        level=config["General"].get("LogLevel", "INFO"),
+        max_bytes=config["General"].getint("LogMaxBytes", 10485760),
+        backups=config["General"].getint("LogBackups", 5),
+        when=config["General"].get("LogRotateWhen", ""),
+    )
+
+    intents = discord.Intents.default()
+    intents.message_content = True
+    client = DNDRoller(intents, config["General"])
+    try:
+        # Keep the queued logging setup instead of letting discord.py install its own handler
+        client.run(config["Discord"]["Token"], log_handler=None)
+    finally:
+        log_listener.stop()
 
 
-intents = discord.Intents.default()
-intents.message_content = True
-client = DNDRoller(intents)
-client.run(config["Discord"]["Token"])
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import configparser
+import re
+import tempfile
+import unittest
+
+from dnd_roller import CommandEngine
+
+URSO = "!c create urso 3 16 12 14 6 10 6 | str con | athletics perception | stealth"
+
+
+class CommandEngineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        settings = configparser.ConfigParser()
+        settings.read_dict({"General": {"Storage": self.directory.name, "Backend": "memory", "RollWorkers": "0", "Admins": "7"}})
+        self.engine = CommandEngine(settings["General"])
+        await self.engine.open()
+
+    async def asyncTearDown(self):
+        await self.engine.close()
+        self.directory.cleanup()
+
+    async def handle(self, content: str) -> list:
+        return await self.engine.handle(content, "1", "7", "Bob", "5")
+
+    async def test_update_rejects_scores_out_of_range(self):
+        await self.handle(URSO)
+        self.assertEqual(await self.handle("!c update urso main 3 40000 12 14 6 10 6"), ["Error: Ability scores must be between 1 and 30."])
+        self.assertEqual(await self.handle("!c update urso main 0 16 12 14 6 10 6"), ["Error: The level must be between 1 and 20."])
+        self.assertEqual(await self.handle("!c update urso main 3 16 12"), ["Error: Expected a level and the six ability scores."])
+        self.assertEqual(await self.handle("!c update urso main 5 18 12 14 6 10 6"), ["Character urso was updated."])
+
+        character = self.engine.cache["1"]["users"]["7"]["characters"]["urso"]
+        self.assertEqual((character.level, character.stats[0]), (5, 18))
+
+    async def test_create_rejects_scores_out_of_range(self):
+        self.assertEqual(await self.handle(URSO.replace(" 16 ", " 40000 ")), ["Error: Ability scores must be between 1 and 30."])
+        self.assertNotIn("urso", self.engine.cache["1"]["users"]["7"]["characters"])
+
+    async def counter(self, name: str) -> int:
+        return int(re.search(rf"^{name}: (\d+)$", (await self.handle("!metrics"))[0], re.MULTILINE).group(1))
+
+    async def test_metrics_report_the_expression_cache(self):
+        await self.handle("!r 1d20+5")
+        hits = await self.counter("expression cache hits")
+        await self.handle("!r 1d20+5")
+        self.assertGreater(await self.counter("expression cache hits"), hits)
+        self.assertEqual(await self.counter("expression cache misses"), 1)
+
+    async def test_metrics_report_the_odds_cache(self):
+        await self.handle("!o 1d20+5 vs 15")
+        await self.handle("!o 1d20+5 vs 12")
+        self.assertEqual(await self.counter("odds cache hits"), 1)
+        self.assertEqual(await self.counter("odds cache misses"), 1)
+
+    async def test_metrics_report_the_resident_guilds(self):
+        await self.handle("!r 1d20")
+        report = (await self.handle("!metrics"))[0]
+        self.assertIn("resident guilds: 1 (max 1)", report)
+        self.assertEqual(await self.counter("guild evictions"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import d20
+
+from utils.history import COUNT, ONES, SUM, Entry, RollHistory
+from utils.rolls import roll_tree
+
+
+class RollHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = RollHistory(None, 4)
+        self.history.open()
+
+    def tearDown(self):
+        self.history.close()
+
+    def roll(self, expression: str, user: str = "7") -> Entry:
+        entry = Entry.from_roll("5", user, expression, roll_tree(d20.parse(expression)))
+        self.history.append(entry)
+        return entry
+
+    def test_only_the_first_dice_term_counts(self):
+        entry = self.roll("1d20+1d4+2d6")
+        self.assertEqual((entry.die, entry.count), (20, 1))
+        self.assertEqual(set(self.history.luck[7]), {20})
+        self.assertEqual(self.history.luck[7][20][SUM], entry.natural)
+
+    def test_rolls_without_dice_count_as_rolls_only(self):
+        self.roll("5+3")
+        self.assertEqual(self.history.rolls[7], 1)
+        self.assertNotIn(7, self.history.luck)
+
+    def test_overwritten_rolls_leave_the_statistics(self):
+        for _ in range(4):
+            self.roll("1d1")
+        self.roll("1d1", user="8")
+        self.assertEqual((self.history.rolls[7], self.history.rolls[8]), (3, 1))
+        self.assertEqual(self.history.luck[7][1][COUNT], 3)
+        self.assertEqual(self.history.luck[7][1][ONES], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
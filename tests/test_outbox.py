@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+
+from utils.metrics import Metrics
+from utils.outbox import Outbox, coalesce, coalesce_owned
+
+
+class FakeChannel:
+    def __init__(self, fail_on: int):
+        self.id = 1
+        self.fail_on = fail_on
+        self.calls = 0
+        self.sent = []
+
+    async def send(self, message: str) -> None:
+        self.calls += 1
+        await asyncio.sleep(0)
+        if self.calls == self.fail_on:
+            raise OSError("connection reset")
+        self.sent.append(message)
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_merges_replies_up_to_the_limit(self):
+        self.assertEqual(coalesce(["a", "", "b", "c" * 5], limit=5), ["a\nb", "ccccc"])
+
+    def test_tracks_the_owners_of_each_message(self):
+        messages = coalesce_owned([(0, "a"), (1, "b"), (1, "c" * 5), (2, "d")], limit=5)
+        self.assertEqual(messages, [["a\nb", {0, 1}], ["ccccc", {1}], ["d", {2}]])
+
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failed_message_only_fails_its_senders(self):
+        outbox = Outbox(Metrics())
+        channel = FakeChannel(fail_on=2)
+
+        # The replies are merged three to a message, and the second message fails
+        replies = [[f"{sender}" * 600] for sender in range(10)]
+        results = await asyncio.gather(*(outbox.send(channel, reply) for reply in replies), return_exceptions=True)
+
+        failed = [sender for sender, result in enumerate(results) if isinstance(result, OSError)]
+        self.assertEqual(failed, [3, 4, 5])
+        self.assertEqual(channel.calls, 4)
+        delivered = "\n".join(channel.sent)
+        for sender, reply in enumerate(replies):
+            self.assertEqual(reply[0] in delivered, sender not in failed)
+        self.assertEqual(outbox.depth, 0)
+
+    async def test_later_sends_succeed_after_a_failure(self):
+        outbox = Outbox(Metrics())
+        channel = FakeChannel(fail_on=1)
+        with self.assertRaises(OSError):
+            await outbox.send(channel, ["first"])
+        await outbox.send(channel, ["second"])
+        self.assertEqual(channel.sent, ["second"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+from utils.rolls import ReferenceResolver, ResolveError
+
+
+class ReferenceResolverTest(unittest.TestCase):
+    def setUp(self):
+        symbols = {"str": "16", "str_mod": "3", "prof": "2"}
+        variables = {"sneak-attack": "3d6", "sneak": "1", "combo": "$sneak-attack+$str_mod", "loop": "$loop"}
+        self.resolver = ReferenceResolver(symbols, variables)
+
+    def test_longest_name_wins(self):
+        self.assertEqual(self.resolver.resolve("1d20+$str_mod+$str"), "1d20+3+16")
+
+    def test_variable_names_with_dashes(self):
+        self.assertEqual(self.resolver.resolve("1d20+$sneak-attack+$sneak"), "1d20+3d6+1")
+
+    def test_nested_variables(self):
+        self.assertEqual(self.resolver.resolve("$combo"), "3d6+3")
+
+    def test_unknown_reference(self):
+        with self.assertRaisesRegex(ResolveError, r"unknown reference \$nope"):
+            self.resolver.resolve("1d20+$nope-1")
+
+    def test_reference_cycle(self):
+        with self.assertRaisesRegex(ResolveError, "references itself"):
+            self.resolver.resolve("$loop")
+
+
+if __name__ == "__main__":
+    unittest.main()
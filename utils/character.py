@@ -0,0 +1,206 @@
+"""Character Data"""
+
+import math
+from array import array
+
+from utils.rolls import ReferenceResolver
+
+STATS = ["str", "dex", "con", "int", "wis", "cha"]
+
+STAT_NAMES = {
+    "str": "strength",
+    "dex": "dexterity",
+    "con": "constitution",
+    "int": "intelligence",
+    "wis": "wisdom",
+    "cha": "charisma",
+}
+
+# The ranges the rules allow for a character's level and ability scores
+LEVELS = range(1, 21)
+SCORES = range(1, 31)
+
+SKILLS = [
+    "acrobatics",
+    "animal_handling",
+    "arcana",
+    "athletics",
+    "deception",
+    "history",
+    "insight",
+    "intimidation",
+    "investigation",
+    "medicine",
+    "nature",
+    "perception",
+    "performance",
+    "persuasion",
+    "religion",
+    "sleight_of_hand",
+    "stealth",
+    "survival",
+]
+
+SKILL_STATS = {
+    "acrobatics": "dex",
+    "animal_handling": "wis",
+    "arcana": "int",
+    "athletics": "str",
+    "deception": "cha",
+    "history": "int",
+    "insight": "wis",
+    "intimidation": "cha",
+    "investigation": "int",
+    "medicine": "wis",
+    "nature": "int",
+    "perception": "wis",
+    "performance": "cha",
+    "persuasion": "cha",
+    "religion": "int",
+    "sleight_of_hand": "dex",
+    "stealth": "dex",
+    "survival": "wis",
+}
+
+
+ABILITIES = SKILLS + STATS
+
+STAT_BITS = {stat: 1 << i for i, stat in enumerate(STATS)}
+SKILL_BITS = {skill: 1 << i for i, skill in enumerate(SKILLS)}
+ABILITY_BITS = {ability: 1 << i for i, ability in enumerate(ABILITIES)}
+
+
+def to_mask(names: list, bits: dict) -> int:
+    """Packs a list of stat/skill names into a bitmask, ignoring unknown names"""
+    mask = 0
+    for name in names:
+        mask |= bits.get(name, 0)
+    return mask
+
+
+def from_mask(mask: int, bits: dict) -> list:
+    """Unpacks a bitmask into the list of stat/skill names it holds, in canonical order"""
+    return [name for name, bit in bits.items() if mask & bit]
+
+
+def check_scores(level: int, scores: list) -> str:
+    """Returns an error if the level or an ability score is out of range, or an empty string"""
+    if level not in LEVELS:
+        return f"Error: The level must be between {LEVELS[0]} and {LEVELS[-1]}."
+    if any(score not in SCORES for score in scores):
+        return f"Error: Ability scores must be between {SCORES[0]} and {SCORES[-1]}."
+    return ""
+
+
+class Character:
+    """A character sheet with its ability scores in a fixed array and its proficiencies as bitmasks
+
+    Saving throw proficiencies are a bitmask over STATS, skill proficiencies and expertise over SKILLS and
+    advantage over ABILITIES, so every check is a bit test. The JSON form is the historical dict of lists,
+    which from_json and to_json convert losslessly, up to the order of the names in each list.
+    """
+
+    __slots__ = ("level", "stats", "save_prof", "skill_prof", "skill_expertise", "advantage", "ability_bonus", "skill_bonus", "macros", "variables")
+
+    def __init__(
+        self,
+        level: int,
+        stats: list,
+        save_prof: int = 0,
+        skill_prof: int = 0,
+        skill_expertise: int = 0,
+        advantage: int = 0,
+        ability_bonus: int = 0,
+        skill_bonus: int = 0,
+        macros: dict = None,
+        variables: dict = None,
+    ):
+        self.level = level
+        self.stats = array("h", stats)
+        self.save_prof = save_prof
+        self.skill_prof = skill_prof
+        self.skill_expertise = skill_expertise
+        self.advantage = advantage
+        self.ability_bonus = ability_bonus
+        self.skill_bonus = skill_bonus
+        self.macros = {} if macros is None else macros
+        self.variables = {} if variables is None else variables
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Character":
+        """Builds a character from its JSON form"""
+        return cls(
+            data["level"],
+            [data["stats"][stat] for stat in STATS],
+            save_prof=to_mask(data.get("save_prof", []), STAT_BITS),
+            skill_prof=to_mask(data.get("skill_prof", []), SKILL_BITS),
+            skill_expertise=to_mask(data.get("skill_expertise", []), SKILL_BITS),
+            advantage=to_mask(data.get("advantage", []), ABILITY_BITS),
+            ability_bonus=data.get("ability_bonus", 0),
+            skill_bonus=data.get("skill_bonus", 0),
+            macros=dict(data.get("macros", {})),
+            variables=dict(data.get("variables", {})),
+        )
+
+    def to_json(self) -> dict:
+        """Returns the JSON form of the character"""
+        return {
+            "level": self.level,
+            "stats": dict(zip(STATS, self.stats)),
+            "save_prof": from_mask(self.save_prof, STAT_BITS),
+            "skill_prof": from_mask(self.skill_prof, SKILL_BITS),
+            "skill_expertise": from_mask(self.skill_expertise, SKILL_BITS),
+            "advantage": from_mask(self.advantage, ABILITY_BITS),
+            "ability_bonus": self.ability_bonus,
+            "skill_bonus": self.skill_bonus,
+            "macros": dict(self.macros),
+            "variables": dict(self.variables),
+        }
+
+    def proficient_save(self, stat: str) -> bool:
+        """Checks whether the character is proficient in a stat's saving throws"""
+        return bool(self.save_prof & STAT_BITS.get(stat, 0))
+
+    def proficient(self, skill: str) -> bool:
+        """Checks whether the character is proficient in a skill"""
+        return bool(self.skill_prof & SKILL_BITS.get(skill, 0))
+
+    def expert(self, skill: str) -> bool:
+        """Checks whether the character has expertise in a skill"""
+        return bool(self.skill_expertise & SKILL_BITS.get(skill, 0))
+
+    def has_advantage(self, ability: str) -> bool:
+        """Checks whether the character always rolls a stat or skill with advantage"""
+        return bool(self.advantage & ABILITY_BITS.get(ability, 0))
+
+
+class DerivedStats:
+    """Precomputed modifiers and reference symbols of a character, rebuilt only when the character changes"""
+
+    __slots__ = ("level", "prof", "scores", "stat_mods", "save_mods", "skill_mods", "skill_marks", "resolver")
+
+    def __init__(self, character: Character):
+        self.level = character.level
+        self.prof = math.floor((character.level - 1) / 4) + 2
+        self.scores = dict(zip(STATS, character.stats))
+        self.stat_mods = {stat: math.floor(score / 2) - 5 for stat, score in self.scores.items()}
+        self.save_mods = {stat: mod + (self.prof if character.proficient_save(stat) else 0) for stat, mod in self.stat_mods.items()}
+        self.skill_mods = {}
+        self.skill_marks = {}
+
+        for skill in SKILLS:
+            mod = self.stat_mods[SKILL_STATS[skill]]
+            if character.proficient(skill):
+                self.skill_mods[skill], self.skill_marks[skill] = mod + self.prof, "✓"
+            elif character.expert(skill):
+                self.skill_mods[skill], self.skill_marks[skill] = mod + self.prof * 2, "✓✓"
+            else:
+                self.skill_mods[skill], self.skill_marks[skill] = mod, ""
+
+        symbols = {"level": str(self.level), "prof": str(self.prof)}
+        for stat in STATS:
+            symbols[stat] = str(self.scores[stat])
+            symbols[f"{stat}_mod"] = str(self.stat_mods[stat])
+        for skill in SKILLS:
+            symbols[skill] = str(self.skill_mods[skill])
+        self.resolver = ReferenceResolver(symbols, character.variables)
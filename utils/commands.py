@@ -0,0 +1,45 @@
+"""Command Routing"""
+
+
+class Command:
+    """A routable command: its handler or usage text, whether it needs user state and its subcommands
+
+    Handlers are called with (guild, author, fields) and return the reply, a list of replies or None. Handlers
+    of per-channel commands, whose state lives with the channel the message was sent in, also get the channel.
+    Commands with user state run under their guild's lock unless they are marked as not exclusive, which
+    suits slow read-only commands that do not change state across suspension points. Those only hold the
+    lock while their author is set up and take it again for any step that must not interleave with changes.
+    """
+
+    __slots__ = ("name", "handler", "usage", "user_state", "exclusive", "per_channel", "prepare", "subcommands")
+
+    def __init__(
+        self, name: str, handler=None, usage: str = None, user_state: bool = True, exclusive: bool = True, per_channel: bool = False, prepare=None
+    ):
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        self.user_state = user_state
+        self.exclusive = exclusive
+        self.per_channel = per_channel
+        self.prepare = prepare
+        self.subcommands = {}
+
+    def add(self, aliases: list, name: str, handler) -> "Command":
+        """Registers a subcommand under each of its aliases"""
+        subcommand = Command(f"{self.name} {name}", handler, user_state=self.user_state, exclusive=self.exclusive, per_channel=self.per_channel)
+        for alias in aliases:
+            self.subcommands[alias] = subcommand
+        return self
+
+    def route(self, fields: list) -> "Command":
+        """Returns the subcommand selected by the second field, or the command itself"""
+        if len(fields) > 1:
+            return self.subcommands.get(fields[1], self)
+        return self
+
+
+def register(registry: dict, aliases: list, command: Command) -> None:
+    """Maps each alias of a command to it in a routing table"""
+    for alias in aliases:
+        registry[alias] = command
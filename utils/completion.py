@@ -0,0 +1,73 @@
+"""Name Completion
+
+Autocomplete is answered from sorted name arrays, so a prefix query costs a binary search plus the names it
+returns. A user's index is built from their characters on first use and then kept in step by the commands
+that add or remove names, so it is never rebuilt while it stays cached.
+"""
+
+import bisect
+
+# Discord shows at most 25 autocomplete choices
+MAX_CHOICES = 25
+
+
+class PrefixIndex:
+    """Sorted names answering prefix queries"""
+
+    __slots__ = ("names",)
+
+    def __init__(self, names=()):
+        self.names = sorted(set(names))
+
+    def add(self, name: str) -> None:
+        """Adds a name unless it is already indexed"""
+        index = bisect.bisect_left(self.names, name)
+        if index == len(self.names) or self.names[index] != name:
+            self.names.insert(index, name)
+
+    def remove(self, name: str) -> None:
+        """Removes a name if it is indexed"""
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            del self.names[index]
+
+    def complete(self, prefix: str, limit: int = MAX_CHOICES) -> list:
+        """Returns up to limit names starting with the prefix, in order"""
+        # Names sharing the prefix sort next to each other, starting where the prefix itself would go
+        start = bisect.bisect_left(self.names, prefix)
+        end = start + limit
+        return [name for name in self.names[start:end] if name.startswith(prefix)]
+
+
+class UserNames:
+    """Prefix indexes over the names of a user's characters and of each character's macros and variables"""
+
+    __slots__ = ("characters", "macros", "variables")
+
+    def __init__(self, characters: dict):
+        self.characters = PrefixIndex(characters)
+        self.macros = {}
+        self.variables = {}
+        for name, character in characters.items():
+            self.add_character(name, character)
+
+    def add_character(self, name: str, character) -> None:
+        """Indexes a new or replaced character along with its macros and variables"""
+        self.characters.add(name)
+        self.macros[name] = PrefixIndex(character.macros)
+        self.variables[name] = PrefixIndex(character.variables)
+
+    def remove_character(self, name: str) -> None:
+        """Drops a character and its macros and variables from the index"""
+        self.characters.remove(name)
+        self.macros.pop(name, None)
+        self.variables.pop(name, None)
+
+    def of(self, kind: str, character: str) -> PrefixIndex:
+        """Returns the index of a character's macros or variables, empty if the character is unknown"""
+        return getattr(self, kind).get(character) or PrefixIndex()
+
+
+def merge(*completions: list, limit: int = MAX_CHOICES) -> list:
+    """Combines the completions of several indexes into one sorted list of at most limit names"""
+    return sorted(set().union(*completions))[:limit]
@@ -0,0 +1,73 @@
+"""Initiative Tracking
+
+An encounter lives in the guild state as a plain dict, so it is persisted like the rest of the state. It holds
+its combatants in initiative order, the index of the combatant whose turn it is (-1 until the first turn),
+the round and a counter of arrivals. Combatants are [-initiative, -dex mod, arrival, name] lists, so their
+natural order is the initiative order with ties going to the higher dex mod, then to whoever came first,
+and bisect keeps them sorted.
+"""
+
+import bisect
+
+MAX_COMBATANTS = 50
+
+
+def new_encounter() -> dict:
+    """Returns an encounter without combatants"""
+    return {"order": [], "turn": -1, "round": 1, "arrivals": 0}
+
+
+def add(encounter: dict, name: str, initiative: int, dex: int) -> None:
+    """Adds a combatant in initiative order, keeping the turn on the current combatant"""
+    entry = [-initiative, -dex, encounter["arrivals"], name]
+    encounter["arrivals"] += 1
+    index = bisect.bisect(encounter["order"], entry)
+    encounter["order"].insert(index, entry)
+    if index <= encounter["turn"]:
+        encounter["turn"] += 1
+
+
+def remove(encounter: dict, name: str) -> bool:
+    """Removes a combatant, handing the turn to the next one if it was theirs"""
+    order = encounter["order"]
+    index = find(encounter, name)
+    if index < 0:
+        return False
+
+    del order[index]
+    if index < encounter["turn"]:
+        encounter["turn"] -= 1
+    elif index == encounter["turn"] and index == len(order):
+        encounter["turn"] = 0 if order else -1
+        encounter["round"] += 1 if order else 0
+    return True
+
+
+def advance(encounter: dict) -> list:
+    """Moves the turn to the next combatant and returns them, or None if there are no combatants"""
+    if not encounter["order"]:
+        return None
+
+    encounter["turn"] += 1
+    if encounter["turn"] == len(encounter["order"]):
+        encounter["turn"] = 0
+        encounter["round"] += 1
+    return encounter["order"][encounter["turn"]]
+
+
+def find(encounter: dict, name: str) -> int:
+    """Returns the position of a combatant in the initiative order, or -1"""
+    for index, entry in enumerate(encounter["order"]):
+        if entry[3] == name:
+            return index
+    return -1
+
+
+def render(encounter: dict) -> str:
+    """Formats the initiative order, marking the combatant whose turn it is"""
+    lines = ["```", f"Round {encounter['round']}"]
+    for index, (initiative, _, _, name) in enumerate(encounter["order"]):
+        marker = ">" if index == encounter["turn"] else " "
+        lines.append(f"{marker} {-initiative:>3} {name.capitalize()}")
+    lines.append("```")
+    return "\n".join(lines)
@@ -0,0 +1,253 @@
+"""Roll History
+
+Each guild keeps its latest rolls in a file holding a header and a fixed number of fixed-size records, used as a
+ring: the record after the newest one is the oldest and is the next to be overwritten, so the file never grows.
+The file is memory-mapped, which makes appends and reads plain memory copies. Writes reach the page cache right
+away and the kernel writes them back, so they survive the bot crashing without any flushing on its side.
+
+Luck statistics are running sums per user and die size over the first dice term of each roll in the ring. They
+are built once when the file is opened and adjusted as records enter and leave the ring, so reading them never
+scans the history.
+"""
+
+import asyncio
+import logging
+import mmap
+import os
+import time
+from collections import OrderedDict
+from struct import Struct
+from typing import NamedTuple
+
+import d20
+
+MAGIC = b"DNDH"
+VERSION = 1
+
+# Magic, version, capacity and number of records ever written, padded to the size of a record
+HEADER = Struct("<4sIQQ")
+# Time, channel, user, total, die size, natural, dice counted, ones, maxes, sum and sum of squares of the faces, and
+# the expression, which is cut to fit
+RECORD = Struct("<dQQiBBBBBxHI24s")
+
+# Running sums kept per user and die size
+COUNT, SUM, SQUARES, ONES, MAXES = range(5)
+
+
+class Entry(NamedTuple):
+    """A roll as it is stored in the history
+
+    The dice statistics cover the first dice term of the roll, such as the d20 of a check. The natural is the
+    value of that term when it keeps a single die, and 0 otherwise.
+    """
+
+    time: float
+    channel: int
+    user: int
+    total: int
+    die: int
+    natural: int
+    count: int
+    ones: int
+    maxes: int
+    faces: int
+    squares: int
+    expression: bytes
+
+    @classmethod
+    def from_roll(cls, channel: str, user: str, expression: str, roll: d20.RollResult) -> "Entry":
+        """Summarizes a roll for the history, counting only its first dice term towards luck, so the d4 of 1d20+1d4 is left out"""
+        dice = first_dice(roll.expr)
+        if dice is None or dice.size > 255:
+            die, natural, values = 0, 0, []
+        else:
+            kept = [value.number for value in dice.keptset]
+            die, natural, values = dice.size, kept[0] if len(kept) == 1 else 0, [value.number for value in dice.values[:255]]
+
+        return cls(
+            time.time(),
+            int(channel) if channel.isdigit() else 0,
+            int(user) if user.isdigit() else 0,
+            max(-(2**31), min(2**31 - 1, int(roll.total))),
+            die,
+            natural,
+            len(values),
+            values.count(1),
+            values.count(die),
+            sum(values),
+            sum(value * value for value in values),
+            expression.encode("utf-8"),
+        )
+
+
+def first_dice(node: d20.ast.Node):
+    """Returns the first dice term of a rolled expression, or None if it rolls no dice"""
+    if isinstance(node, d20.Dice):
+        return node
+    for child in node.children:
+        dice = first_dice(child)
+        if dice is not None:
+            return dice
+    return None
+
+
+class RollHistory:
+    """The latest rolls of a guild in a memory-mapped ring of records, with running luck statistics per user
+
+    The number of rolls each user has in the ring is kept alongside, as the sample their statistics cover.
+    Without a path the ring is kept in anonymous memory, which is how the memory backend uses it.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.written = 0
+        self.luck = {}
+        self.rolls = {}
+
+        self._map = None
+
+    def open(self) -> None:
+        """Maps the history file, creating it or resizing it to the capacity, and builds the luck statistics"""
+        capacity = self._stored_capacity()
+        if capacity is not None and capacity != self.capacity:
+            # Keep the newest records that fit the new capacity
+            old = RollHistory(self.path, capacity)
+            old.open()
+            entries = old.latest(self.capacity)
+            old.close()
+            os.unlink(self.path)
+            logging.info("Resizing roll history %s from %d to %d records", self.path, capacity, self.capacity)
+            self._map_file()
+            for entry in reversed(entries):
+                self.append(entry)
+            return
+
+        self._map_file()
+        for entry in self.latest(self.capacity):
+            self._count(entry, 1)
+
+    def close(self) -> None:
+        """Writes back and unmaps the history file"""
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+
+    def append(self, entry: Entry) -> None:
+        """Adds a roll, overwriting the oldest one once the ring is full"""
+        slot = self.written % self.capacity
+        if self.written >= self.capacity:
+            self._count(self._read(slot), -1)
+
+        RECORD.pack_into(self._map, RECORD.size * (slot + 1), *entry)
+        self.written += 1
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.capacity, self.written)
+        self._count(entry, 1)
+
+    def latest(self, count: int, channel: int = None, user: int = None) -> list:
+        """Returns up to count of the newest rolls, newest first, optionally only those of a channel or a user"""
+        entries = []
+        for written in range(self.written - 1, max(self.written - self.capacity, 0) - 1, -1):
+            if len(entries) >= count:
+                break
+            entry = self._read(written % self.capacity)
+            if (channel is None or entry.channel == channel) and (user is None or entry.user == user):
+                entries.append(entry)
+        return entries
+
+    def _stored_capacity(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as fd:
+            header = fd.read(HEADER.size)
+        if len(header) < HEADER.size or header[:4] != MAGIC:
+            return None
+        return HEADER.unpack(header)[2]
+
+    def _map_file(self) -> None:
+        size = RECORD.size * (self.capacity + 1)
+        if self.path is None:
+            self._map = mmap.mmap(-1, size)
+        else:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a+b") as fd:
+                if os.fstat(fd.fileno()).st_size != size:
+                    fd.truncate(size)
+                self._map = mmap.mmap(fd.fileno(), size)
+
+        magic, _, _, written = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.capacity, 0)
+            written = 0
+        self.written = written
+
+    def _read(self, slot: int) -> Entry:
+        return Entry._make(RECORD.unpack_from(self._map, RECORD.size * (slot + 1)))
+
+    def _count(self, entry: Entry, sign: int) -> None:
+        self.rolls[entry.user] = self.rolls.get(entry.user, 0) + sign
+        if not entry.die:
+            return
+        stats = self.luck.setdefault(entry.user, {}).setdefault(entry.die, [0] * 5)
+        stats[COUNT] += sign * entry.count
+        stats[SUM] += sign * entry.faces
+        stats[SQUARES] += sign * entry.squares
+        stats[ONES] += sign * entry.ones
+        stats[MAXES] += sign * entry.maxes
+
+
+class HistoryStore:
+    """Opens the roll history of each guild on demand and keeps at most max_open of them mapped, least recently used first out
+
+    Without a directory the histories are kept in memory and are lost when they are closed.
+    """
+
+    def __init__(self, directory: str = None, capacity: int = 10000, max_open: int = 256):
+        self.directory = directory
+        self.capacity = capacity
+        self.max_open = max_open
+
+        self._open = OrderedDict()
+
+    async def get(self, guild: str) -> RollHistory:
+        """Returns the roll history of a guild, opening it if needed"""
+        history = self._open.get(guild)
+        if history is not None:
+            self._open.move_to_end(guild)
+            return history
+
+        path = os.path.join(self.directory, f"{guild}.bin") if self.directory is not None else None
+        history = RollHistory(path, self.capacity)
+        await asyncio.to_thread(history.open)
+        if guild in self._open:
+            # Opened concurrently, keep the first one
+            history.close()
+            return self._open[guild]
+
+        self._open[guild] = history
+        if len(self._open) > self.max_open:
+            _, oldest = self._open.popitem(last=False)
+            await asyncio.to_thread(oldest.close)
+        return history
+
+    async def close(self) -> None:
+        """Writes back and unmaps every open history"""
+        histories, self._open = list(self._open.values()), OrderedDict()
+        for history in histories:
+            await asyncio.to_thread(history.close)
+
+
+def describe_luck(stats: dict) -> str:
+    """Formats the luck statistics of a user, comparing them with what fair dice would give"""
+    lines = []
+    for die, (count, total, squares, ones, maxes) in sorted(stats.items()):
+        if not count:
+            continue
+        mean = total / count
+        deviation = max(squares / count - mean * mean, 0) ** 0.5
+        lines.append(
+            f"d{die:<3} {count:>6} dice  mean {mean:5.2f} ({(die + 1) / 2:5.2f})  sd {deviation:5.2f} ({((die * die - 1) / 12) ** 0.5:5.2f})"
+            f"  1s {ones} ({ones / count:.1%})  {die}s {maxes} ({maxes / count:.1%})  fair {1 / die:.1%}"
+        )
+    return "\n".join(lines)
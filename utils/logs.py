@@ -0,0 +1,36 @@
+"""Logging Setup"""
+
+import logging
+import os
+import queue
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+
+
+def setup_logging(path: str, level: str = "INFO", max_bytes: int = 10485760, backups: int = 5, when: str = "") -> QueueListener:
+    """Routes all log records through a queue to a rotating file written by a listener thread
+
+    Records are rotated daily, hourly, etc. when a rotation interval is given, and by size otherwise.
+    The returned listener must be stopped on shutdown to flush the remaining records.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if when:
+        handler = TimedRotatingFileHandler(path, when=when, backupCount=backups, encoding="utf-8")
+    else:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s : %(levelname)s : %(name)s : %(message)s"))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level.upper())
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
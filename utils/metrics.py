@@ -0,0 +1,96 @@
+"""Command Latency Metrics"""
+
+import math
+import os
+import tempfile
+
+MIN_LATENCY = 0.00001
+BUCKETS_PER_DOUBLING = 8
+BUCKETS = 200
+
+
+class LatencyHistogram:
+    """Log-scaled latency histogram, accurate to within about 9% for any percentile in constant memory"""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds: float) -> None:
+        """Adds one latency sample"""
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[self._bucket(seconds)] += 1
+
+    def percentile(self, percent: float) -> float:
+        """Returns the upper bound of the bucket holding the given percentile"""
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket, amount in enumerate(self.buckets):
+            seen += amount
+            if amount and seen >= rank:
+                return min(self.max, MIN_LATENCY * 2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING))
+        return self.max
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        if seconds <= MIN_LATENCY:
+            return 0
+        return min(BUCKETS - 1, int(math.log2(seconds / MIN_LATENCY) * BUCKETS_PER_DOUBLING))
+
+
+class Metrics:
+    """Latency histograms keyed by command name, plus counters and gauges holding the current and peak value of a quantity"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        """Adds a latency sample for a command"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        """Adds to a counter"""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count(self, name: str, total: int) -> None:
+        """Sets a counter to a total kept elsewhere, such as by a cache"""
+        self.counters[name] = total
+
+    def gauge(self, name: str, value: int) -> None:
+        """Sets the current value of a gauge"""
+        self.gauges[name] = (value, max(value, self.gauges.get(name, (0, 0))[1]))
+
+    def report(self) -> str:
+        """Formats the sample count and latency percentiles of every command as a table"""
+        width = max([len(name) for name in self.histograms] + [7])
+        lines = [f"{'command'.ljust(width)} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}"]
+        for name, histogram in sorted(self.histograms.items()):
+            latencies = [histogram.percentile(50), histogram.percentile(95), histogram.percentile(99), histogram.max]
+            lines.append(f"{name.ljust(width)} {histogram.count:>7} " + " ".join(f"{latency * 1000:>7.2f}ms" for latency in latencies))
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name}: {value}")
+        for name, (value, peak) in sorted(self.gauges.items()):
+            lines.append(f"{name}: {value} (max {peak})")
+        return "\n".join(lines)
+
+    def write(self, path: str, report: str = None) -> None:
+        """Atomically replaces the metrics file with a report, the current one by default
+
+        Pass a report made on the event loop when writing from a thread, as the metrics change while they are formatted.
+        """
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, encoding="utf-8") as file:
+            file.write(f"{self.report() if report is None else report}\n")
+        os.replace(file.name, path)
@@ -0,0 +1,218 @@
+"""Exact Roll Probabilities"""
+
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import d20
+
+from utils.rolls import CostError
+
+MAX_DICE = 100
+MAX_OUTCOMES = 20000
+
+
+class OddsError(Exception):
+    """Raised when the distribution of an expression cannot be computed"""
+
+
+@lru_cache(maxsize=256)
+def dice_distribution(num: int, size: int) -> dict:
+    """Distribution of the sum of num dice of the given size
+
+    The returned dict is shared between callers and must not be modified.
+    """
+    dist = {0: 1.0}
+    face = 1.0 / size
+    for _ in range(num):
+        step = {}
+        for total, prob in dist.items():
+            for value in range(1, size + 1):
+                step[total + value] = step.get(total + value, 0.0) + prob * face
+        dist = step
+    return dist
+
+
+@lru_cache(maxsize=256)
+def keep_distribution(num: int, size: int, keep: int, highest: bool) -> dict:
+    """Distribution of the sum of the highest (or lowest) keep dice out of num dice of the given size
+
+    Walks the faces from the kept end, counting the ways to assign the remaining dice to each face,
+    so the cost grows with num * keep * size^2 instead of size^num.
+    The returned dict is shared between callers and must not be modified.
+    """
+    keep = max(0, min(keep, num))
+    ways = {(0, 0): 1}
+    faces = range(size, 0, -1) if highest else range(1, size + 1)
+    for face in faces:
+        step = {}
+        for (assigned, total), count in ways.items():
+            for extra in range(num - assigned + 1):
+                kept = min(extra, max(0, keep - assigned))
+                state = (assigned + extra, total + kept * face)
+                step[state] = step.get(state, 0) + count * math.comb(num - assigned, extra)
+        ways = step
+
+    outcomes = size**num
+    dist = {}
+    for (assigned, total), count in ways.items():
+        if assigned == num:
+            dist[total] = dist.get(total, 0.0) + count / outcomes
+    return dist
+
+
+def odds_cost(tree: d20.ast.Node) -> int:
+    """Estimates the work of computing the distribution of a parsed expression
+
+    Summing num dice of a size costs about num^2 * size^2 steps, keeping dice out of them about num^2 * keep * size^2.
+    """
+    cost = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, d20.ast.OperatedDice) and isinstance(node.value, d20.ast.Dice):
+            num, size = node.value.num, node.value.size if isinstance(node.value.size, int) else 100
+            keep = num
+            if len(node.operations) == 1 and len(node.operations[0].sels) == 1:
+                operation = node.operations[0]
+                keep = operation.sels[0].num if operation.op == "k" else num - operation.sels[0].num
+            cost += num * num * max(1, min(keep, num)) * size * size
+        elif isinstance(node, d20.ast.Dice):
+            size = node.size if isinstance(node.size, int) else 100
+            cost += node.num * node.num * size * size
+        else:
+            stack.extend(node.children)
+    return cost
+
+
+def exact_distribution(expr: str) -> dict:
+    """Parses an expression and computes its distribution in one call, so it can run in a worker process"""
+    return OddsEngine(0).compute(d20.parse(expr))
+
+
+class OddsEngine:
+    """Computes exact outcome distributions of d20 expressions by convolving dice distributions
+
+    The cache may be used from worker threads; it is guarded by a lock held only while it is used.
+    """
+
+    def __init__(self, maxsize: int = 256, max_cost: int = 5000000):
+        self.maxsize = maxsize
+        self.max_cost = max_cost
+        self.hits = 0
+        self.misses = 0
+
+        self._dists = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, tree: d20.ast.Node) -> int:
+        """Returns the estimated cost of a parsed expression, raising CostError if it is over the limit"""
+        cost = odds_cost(tree)
+        if cost > self.max_cost:
+            raise CostError(f"the odds would take about {cost} steps to compute, the limit is {self.max_cost}")
+        return cost
+
+    def cached(self, expr: str) -> dict:
+        """Returns the cached distribution of an expression, or None"""
+        with self._lock:
+            dist = self._dists.get(expr)
+            if dist is not None:
+                self._dists.move_to_end(expr)
+                self.hits += 1
+                return dist
+            self.misses += 1
+        return None
+
+    def store(self, expr: str, dist: dict) -> None:
+        """Caches the distribution of an expression"""
+        with self._lock:
+            self._dists[expr] = dist
+            if len(self._dists) > self.maxsize:
+                self._dists.popitem(last=False)
+
+    def compute(self, tree: d20.ast.Node) -> dict:
+        """Computes the distribution of a parsed expression, bypassing the cache"""
+        dist = {}
+        for value, prob in self._eval(tree).items():
+            dist[int(value)] = dist.get(int(value), 0.0) + prob
+        return dict(sorted(dist.items()))
+
+    def _eval(self, node: d20.ast.Node) -> dict:
+        # pylint: disable=too-many-return-statements
+        if isinstance(node, d20.ast.Expression):
+            return self._eval(node.roll)
+        if isinstance(node, d20.ast.AnnotatedNumber):
+            return self._eval(node.value)
+        if isinstance(node, d20.ast.Parenthetical):
+            return self._eval(node.value)
+        if isinstance(node, d20.ast.Literal):
+            return {node.value: 1.0}
+        if isinstance(node, d20.ast.UnOp):
+            value = self._eval(node.value)
+            return value if node.op == "+" else {-k: p for k, p in value.items()}
+        if isinstance(node, d20.ast.BinOp):
+            return self._combine(self._eval(node.left), node.op, self._eval(node.right))
+        if isinstance(node, d20.ast.OperatedDice):
+            return self._eval_operated_dice(node)
+        if isinstance(node, d20.ast.Dice):
+            return dice_distribution(*self._check_dice(node))
+        raise OddsError(f"cannot compute odds for {node}")
+
+    def _eval_operated_dice(self, node: d20.ast.OperatedDice) -> dict:
+        num, size = self._check_dice(node.value)
+        if len(node.operations) != 1 or len(node.operations[0].sels) != 1:
+            raise OddsError(f"cannot compute odds for {node}")
+
+        operation = node.operations[0]
+        selector = operation.sels[0]
+        if operation.op == "k" and selector.cat in ["h", "l"]:
+            return keep_distribution(num, size, selector.num, selector.cat == "h")
+        if operation.op == "p" and selector.cat in ["h", "l"]:
+            return keep_distribution(num, size, num - selector.num, selector.cat == "l")
+        raise OddsError(f"cannot compute odds for {node}")
+
+    @staticmethod
+    def _check_dice(node: d20.ast.Dice) -> tuple:
+        if not isinstance(node, d20.ast.Dice) or not isinstance(node.size, int) or node.size < 1:
+            raise OddsError(f"cannot compute odds for {node}")
+        if node.num > MAX_DICE:
+            raise OddsError(f"too many dice in {node}")
+        return node.num, node.size
+
+    @staticmethod
+    def _combine(left: dict, op: str, right: dict) -> dict:
+        func = d20.BinOp.BINARY_OPS.get(op)
+        if func is None:
+            raise OddsError(f"cannot compute odds for the {op} operator")
+        if len(left) * len(right) > MAX_OUTCOMES * 10:
+            raise OddsError("the expression has too many outcomes")
+
+        dist = {}
+        try:
+            for lvalue, lprob in left.items():
+                for rvalue, rprob in right.items():
+                    value = func(lvalue, rvalue)
+                    dist[value] = dist.get(value, 0.0) + lprob * rprob
+        except ZeroDivisionError as ex:
+            raise OddsError("the expression may divide by zero") from ex
+
+        if len(dist) > MAX_OUTCOMES:
+            raise OddsError("the expression has too many outcomes")
+        return dist
+
+
+def summarize(dist: dict, dc: int) -> str:
+    """Formats the chance to meet a DC, the mean and a percentile table of a distribution"""
+    success = sum(prob for value, prob in dist.items() if value >= dc)
+    mean = sum(value * prob for value, prob in dist.items())
+
+    percentiles = []
+    cumulative = 0.0
+    targets = [10, 25, 50, 75, 90]
+    for value, prob in dist.items():
+        cumulative += prob
+        while targets and cumulative * 100 >= targets[0] - 1e-9:
+            percentiles.append(f"{targets.pop(0)}%: {value}")
+
+    return f"P(>= {dc}): {success * 100:.2f}%\nMean: {mean:.2f}\nPercentiles: {' | '.join(percentiles)}"
@@ -0,0 +1,120 @@
+"""Outgoing Message Queues"""
+
+import asyncio
+import logging
+from collections import deque
+from time import perf_counter
+
+import discord
+
+from utils.metrics import Metrics
+
+MAX_LENGTH = 2000
+
+
+def coalesce(replies: list, limit: int = MAX_LENGTH) -> list:
+    """Joins consecutive replies with newlines into as few messages as fit the length limit"""
+    return [message for message, _ in coalesce_owned([(None, reply) for reply in replies], limit)]
+
+
+def coalesce_owned(replies: list, limit: int = MAX_LENGTH) -> list:
+    """Coalesces (owner, reply) pairs, returning each message with the set of owners whose replies it holds"""
+    messages = []
+    for owner, reply in replies:
+        if not reply:
+            continue
+        if messages and len(messages[-1][0]) + 1 + len(reply) <= limit:
+            messages[-1][0] += "\n" + reply
+            messages[-1][1].add(owner)
+        else:
+            messages.append([reply, {owner}])
+    return messages
+
+
+class Outbox:
+    """Per-channel send queues that merge pending replies and back off when Discord rate limits a channel
+
+    Each channel has at most one send in flight. Replies queued while it runs are merged into the next
+    messages, so a burst of commands in a busy channel costs a few REST calls instead of one per reply.
+    """
+
+    def __init__(self, metrics: Metrics, retries: int = 5, backoff: float = 1.0):
+        self.metrics = metrics
+        self.retries = retries
+        self.backoff = backoff
+        self.depth = 0
+
+        self._queues = {}
+        self._workers = {}
+
+    async def send(self, channel: discord.abc.Messageable, replies: list) -> None:
+        """Queues replies for a channel and waits until they were sent"""
+        if not replies:
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(channel.id, deque()).append((replies, future, perf_counter()))
+        self.depth += len(replies)
+        self.metrics.gauge("send queue", self.depth)
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._drain(channel))
+        await future
+
+    async def close(self) -> None:
+        """Waits for the queued replies to be sent"""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def _drain(self, channel: discord.abc.Messageable) -> None:
+        queue = self._queues[channel.id]
+        batch = []
+        try:
+            while queue:
+                batch = list(queue)
+                queue.clear()
+                replies = [reply for replies, _, _ in batch for reply in replies]
+                self.depth -= len(replies)
+                self.metrics.gauge("send queue", self.depth)
+
+                # A failed message only fails the senders with replies in it, the rest of the batch is still sent
+                failed = {}
+                for message, owners in coalesce_owned([(owner, reply) for owner, (replies, _, _) in enumerate(batch) for reply in replies]):
+                    if owners <= failed.keys():
+                        continue
+                    try:
+                        await self._send(channel, message)
+                    except Exception as ex:
+                        # Besides its own exceptions, discord.py lets connection errors and timeouts through
+                        self.metrics.increment("send failures")
+                        for owner in owners:
+                            failed.setdefault(owner, ex)
+
+                for owner, (_, future, queued) in enumerate(batch):
+                    if owner in failed:
+                        future.set_exception(failed[owner])
+                    else:
+                        self.metrics.record("send wait", perf_counter() - queued)
+                        future.set_result(None)
+        finally:
+            # Only cancellation gets here with senders still waiting, which must not wait forever
+            for _, future, _ in batch + list(queue):
+                if not future.done():
+                    future.cancel()
+            del self._queues[channel.id]
+            del self._workers[channel.id]
+
+    async def _send(self, channel: discord.abc.Messageable, message: str) -> None:
+        # discord.py already retries within its rate limit buckets; this covers the 429s it gives up on
+        for attempt in range(self.retries):
+            start = perf_counter()
+            try:
+                await channel.send(message)
+            except discord.HTTPException as ex:
+                if ex.status != 429 or attempt == self.retries - 1:
+                    raise
+                delay = max(self.backoff * 2**attempt, float(ex.response.headers.get("Retry-After", 0)))
+                logging.warning("Rate limited in channel %s, retrying in %.1fs", channel.id, delay)
+                await asyncio.sleep(delay)
+            else:
+                self.metrics.record("send", perf_counter() - start)
+                return
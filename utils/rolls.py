@@ -0,0 +1,177 @@
+"""Roll Expression Handling"""
+
+import re
+from collections import OrderedDict
+
+import d20
+
+from utils.history import Entry
+
+DICE = "dice"
+CHECK = "check"
+MACRO = "macro"
+
+
+MAX_LISTED = 100
+MAX_LENGTH = 2000
+
+
+class ResolveError(Exception):
+    """Raised when an expression holds a reference that cannot be resolved"""
+
+
+class CostError(Exception):
+    """Raised when an expression rolls more dice or nests deeper than allowed"""
+
+
+class ExpressionCache:
+    """LRU cache of parsed d20 expressions, keyed by the fully resolved expression"""
+
+    def __init__(self, maxsize: int = 1024, max_dice: int = 1000, max_depth: int = 32):
+        self.maxsize = maxsize
+        self.max_dice = max_dice
+        self.max_depth = max_depth
+        self.hits = 0
+        self.misses = 0
+
+        self._trees = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+    def parse(self, expr: str) -> d20.ast.Expression:
+        """Returns the parsed tree of an expression, parsing it only if it is not cached"""
+        tree = self._trees.get(expr)
+        if tree is not None:
+            self._trees.move_to_end(expr)
+            self.hits += 1
+            return tree
+
+        self.misses += 1
+        tree = d20.parse(expr)
+        self._trees[expr] = tree
+        if len(self._trees) > self.maxsize:
+            self._trees.popitem(last=False)
+        return tree
+
+    def check(self, tree: d20.ast.Node) -> int:
+        """Returns the number of dice a parsed expression rolls, raising CostError if it is over the limits"""
+        dice, depth = expression_cost(tree)
+        if dice > self.max_dice:
+            raise CostError(f"the expression rolls {dice} dice, the limit is {self.max_dice}")
+        if depth > self.max_depth:
+            raise CostError(f"the expression is nested {depth} levels deep, the limit is {self.max_depth}")
+        return dice
+
+
+def expression_cost(tree: d20.ast.Node) -> tuple[int, int]:
+    """Estimates the cost of evaluating a parsed expression as the number of dice it rolls and its depth"""
+    dice = 0
+    depth = 0
+    stack = [(tree, 1)]
+    while stack:
+        node, level = stack.pop()
+        depth = max(depth, level)
+        if isinstance(node, d20.ast.Dice):
+            dice += node.num
+        stack.extend((child, level + 1) for child in node.children)
+    return dice, depth
+
+
+def roll_tree(tree: d20.ast.Node) -> d20.RollResult:
+    """Rolls a parsed expression with its own roller, so rolls may run in worker threads"""
+    return d20.Roller().roll(tree, stringifier=BoundedStringifier())
+
+
+def render_expression(expr: str, channel: str, user: str, budget: int = MAX_LENGTH) -> tuple:
+    """Parses, rolls and renders an expression in one call, so it can run in a worker process
+
+    Returns the rendered roll and its history entry, which is small enough to send back unlike the roll itself.
+    """
+    roll = roll_tree(d20.parse(expr))
+    return render_roll(roll, budget), Entry.from_roll(channel, user, expr, roll)
+
+
+def render_roll(roll: d20.RollResult, budget: int = MAX_LENGTH) -> str:
+    """Returns the roll result, cut short with its total kept if it does not fit the budget"""
+    if len(roll.result) <= budget:
+        return roll.result
+    total = f" ... = `{roll.total}`"
+    return f"{roll.result[: max(0, budget - len(total))]}{total}"
+
+
+class BoundedStringifier(d20.MarkdownStringifier):
+    """Markdown stringifier that summarizes dice pools too large to list die by die"""
+
+    def __init__(self, max_listed: int = MAX_LISTED, shown: int = 5):
+        super().__init__()
+        self.max_listed = max_listed
+        self.shown = shown
+
+    def _str_dice(self, node: d20.Dice) -> str:
+        if len(node.values) <= self.max_listed:
+            return super()._str_dice(node)
+
+        kept = sorted(int(die.total) for die in node.values if die.kept)
+        highest = ", ".join(str(value) for value in kept[::-1][: self.shown])
+        lowest = ", ".join(str(value) for value in kept[: self.shown])
+        return (
+            f"{node.num}d{node.size}{self._str_ops(node.operations)} "
+            f"({len(node.values)} dice, {len(kept)} kept, highest {highest} ..., lowest {lowest} ...)"
+        )
+
+
+def classify_target(target: str, macros: dict, vocabulary: set) -> str:
+    """Classifies a roll target as a stat/skill check, a macro or dice notation without parsing it"""
+    if target in vocabulary:
+        return CHECK
+    if target in macros:
+        return MACRO
+    return DICE
+
+
+class ReferenceResolver:
+    """Resolves $name references in a single pass over a merged symbol table
+
+    Built-in symbols take precedence over variables. Variables may reference other variables; each one is
+    resolved at most once and reference cycles are reported instead of recursing forever. Variable names may
+    hold any character, so references match the known names, longest first, so that $str_mod is not read as
+    $str and $sneak-attack is not read as $sneak.
+    """
+
+    def __init__(self, symbols: dict, variables: dict):
+        self.symbols = symbols
+        self.variables = variables
+
+        self._pattern = None
+        self._resolved = {}
+        self._resolving = set()
+
+    def resolve(self, value: str) -> str:
+        """Replaces every reference in the value with its resolved value"""
+        if "$" not in value:
+            return value
+        if self._pattern is None:
+            # A reference to no known name is reported by the word it starts with
+            names = "|".join(re.escape(name) for name in sorted(set(self.symbols) | set(self.variables), key=len, reverse=True) if name)
+            self._pattern = re.compile(rf"\$(?:({names or '(?!)'})|(\w+))")
+        return self._pattern.sub(lambda match: self._lookup(match.group(match.lastindex)), value)
+
+    def _lookup(self, name: str) -> str:
+        if name in self.symbols:
+            return self.symbols[name]
+        if name in self._resolved:
+            return self._resolved[name]
+        if name not in self.variables:
+            raise ResolveError(f"unknown reference ${name}")
+        if name in self._resolving:
+            raise ResolveError(f"variable ${name} references itself")
+
+        self._resolving.add(name)
+        try:
+            value = self.resolve(str(self.variables[name]))
+        finally:
+            self._resolving.discard(name)
+
+        self._resolved[name] = value
+        return value
@@ -0,0 +1,80 @@
+"""Bot State Schema
+
+Guild states are brought up to date once when they are loaded, so command handlers can rely on every key
+being present and on characters being Character objects. Each guild stores the schema version it was
+migrated to. Migrations run once and are persisted through storage records, while filling in keys that are
+merely missing and building Characters happens on every load and costs nothing to write.
+"""
+
+import copy
+
+from utils.character import Character
+
+VERSION = 1
+
+GUILD = {"users": {}, "sessions": {"on": [], "off": [], "wday": -1}, "encounters": {}}
+
+USER = {"name": "", "active": "", "characters": {}, "unavailability": []}
+
+CHARACTER = {
+    "save_prof": [],
+    "skill_prof": [],
+    "skill_expertise": [],
+    "advantage": [],
+    "ability_bonus": 0,
+    "skill_bonus": 0,
+    "macros": {},
+    "variables": {},
+}
+
+
+def new_user() -> dict:
+    """Returns the state of a user new to a guild"""
+    return copy.deepcopy(USER)
+
+
+def normalize(state: dict) -> None:
+    """Fills in every key missing from a guild state and its users, and turns character dicts into Characters"""
+    _fill(state, GUILD)
+    _fill(state["sessions"], GUILD["sessions"])
+    for user in state["users"].values():
+        _fill(user, USER)
+        for name, character in user["characters"].items():
+            if not isinstance(character, Character):
+                user["characters"][name] = Character.from_json(character)
+
+
+def migrate(guild: str, state: dict) -> list:
+    """Migrates a loaded guild state in place to the current version and returns the records persisting it"""
+    version = state.get("version", 0)
+    if version >= VERSION:
+        return []
+
+    records = []
+    for migration in MIGRATIONS[version:]:
+        records += migration(guild, state)
+    state["version"] = VERSION
+    records.append(["s", [guild, "version"], VERSION])
+    return records
+
+
+def _fill(node: dict, defaults: dict) -> bool:
+    changed = False
+    for key, value in defaults.items():
+        if key not in node:
+            node[key] = copy.deepcopy(value)
+            changed = True
+    return changed
+
+
+def _complete_characters(guild: str, state: dict) -> list:
+    # Characters created before advantage, bonuses, macros and variables existed lack those fields
+    records = []
+    for user, profile in state.get("users", {}).items():
+        for name, character in profile.get("characters", {}).items():
+            if _fill(character, CHARACTER):
+                records.append(["s", [guild, "users", user, "characters", name], character])
+    return records
+
+
+MIGRATIONS = [_complete_characters]
@@ -0,0 +1,60 @@
+"""Session Calendar Index"""
+
+from bisect import bisect_left
+from datetime import date, timedelta
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+class SessionIndex:
+    """Indexes a guild's session calendar so upcoming sessions are computed from the weekday rule
+
+    Extra sessions are kept sorted for bisecting, cancellations in a set, and unavailability as a
+    date -> user ids map, so lookups never walk the calendar day by day.
+    """
+
+    __slots__ = ("wday", "extra", "off", "unavailable")
+
+    def __init__(self, sessions: dict, users: dict):
+        self.wday = sessions["wday"]
+        self.extra = sorted(set(sessions["on"]))
+        self.off = set(sessions["off"])
+        self.unavailable = {}
+
+        for user, info in users.items():
+            for day in info["unavailability"]:
+                self.unavailable.setdefault(day, []).append(user)
+
+    def upcoming(self, start: date, count: int) -> list:
+        """Returns the dates of the next count sessions on or after the start date"""
+        weekly = self._weekly(start)
+        position = bisect_left(self.extra, start.strftime(DATE_FORMAT))
+        extra = iter(self.extra[position:])
+
+        result = []
+        left, right = next(weekly, None), next(extra, None)
+        while len(result) < count and (left or right):
+            if right is None or (left is not None and left < right):
+                result.append(left)
+                left = next(weekly, None)
+            else:
+                result.append(right)
+                right = next(extra, None)
+                if left == result[-1]:
+                    left = next(weekly, None)
+        return result
+
+    def missing(self, day: str) -> list:
+        """Returns the ids of the users unavailable on a date"""
+        return self.unavailable.get(day, [])
+
+    def _weekly(self, start: date):
+        if self.wday < 0:
+            return
+
+        day = start + timedelta(days=(self.wday - start.weekday()) % 7)
+        while True:
+            datestr = day.strftime(DATE_FORMAT)
+            if datestr not in self.off:
+                yield datestr
+            day += timedelta(days=7)
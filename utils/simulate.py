@@ -0,0 +1,109 @@
+"""Batched Roll Simulation"""
+
+import d20
+import numpy as np
+
+MAX_DICE = 100
+CHUNK_SIZE = 65536
+HISTOGRAM_BINS = 16
+HISTOGRAM_WIDTH = 24
+
+
+class SimulationError(Exception):
+    """Raised when an expression cannot be simulated in bulk"""
+
+
+def simulate(tree: d20.ast.Node, count: int, rng: np.random.Generator = None) -> np.ndarray:
+    """Rolls a parsed expression count times and returns the totals
+
+    Every die of a chunk of rolls is generated and reduced with array operations, so memory stays bounded
+    by CHUNK_SIZE rolls no matter how many are requested.
+    """
+    rng = rng or np.random.default_rng()
+    totals = np.empty(count, dtype=np.int64)
+    for start in range(0, count, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, count)
+        totals[start:end] = _eval(tree, end - start, rng)
+    return totals
+
+
+def _eval(node: d20.ast.Node, count: int, rng: np.random.Generator) -> np.ndarray:
+    # pylint: disable=too-many-return-statements
+    if isinstance(node, d20.ast.Expression):
+        return _eval(node.roll, count, rng)
+    if isinstance(node, (d20.ast.AnnotatedNumber, d20.ast.Parenthetical)):
+        return _eval(node.value, count, rng)
+    if isinstance(node, d20.ast.Literal):
+        return np.full(count, int(node.value), dtype=np.int64)
+    if isinstance(node, d20.ast.UnOp) and node.op in ["+", "-"]:
+        value = _eval(node.value, count, rng)
+        return value if node.op == "+" else -value
+    if isinstance(node, d20.ast.BinOp) and node.op in ["+", "-"]:
+        left, right = _eval(node.left, count, rng), _eval(node.right, count, rng)
+        return left + right if node.op == "+" else left - right
+    if isinstance(node, d20.ast.OperatedDice):
+        return _eval_operated_dice(node, count, rng)
+    if isinstance(node, d20.ast.Dice):
+        return _roll_dice(node, count, rng).sum(axis=1, dtype=np.int64)
+    raise SimulationError(f"cannot simulate {node}")
+
+
+def _eval_operated_dice(node: d20.ast.OperatedDice, count: int, rng: np.random.Generator) -> np.ndarray:
+    if len(node.operations) != 1 or len(node.operations[0].sels) != 1:
+        raise SimulationError(f"cannot simulate {node}")
+
+    operation = node.operations[0]
+    selector = operation.sels[0]
+    if operation.op not in ["k", "p"] or selector.cat not in ["h", "l"]:
+        raise SimulationError(f"cannot simulate {node}")
+
+    rolls = np.sort(_roll_dice(node.value, count, rng), axis=1)
+    num = rolls.shape[1]
+    amount = max(0, min(selector.num, num))
+    rest = num - amount
+    if operation.op == "k":
+        kept = rolls[:, rest:] if selector.cat == "h" else rolls[:, :amount]
+    else:
+        kept = rolls[:, :rest] if selector.cat == "h" else rolls[:, amount:]
+    return kept.sum(axis=1, dtype=np.int64)
+
+
+def _roll_dice(node: d20.ast.Dice, count: int, rng: np.random.Generator) -> np.ndarray:
+    if not isinstance(node, d20.ast.Dice) or not isinstance(node.size, int) or node.size < 1:
+        raise SimulationError(f"cannot simulate {node}")
+    if node.num > MAX_DICE:
+        raise SimulationError(f"too many dice in {node}")
+    return rng.integers(1, node.size + 1, size=(count, node.num), dtype=np.int32)
+
+
+def describe(totals: np.ndarray) -> str:
+    """Formats the mean, spread, percentiles and a histogram of simulated totals"""
+    percentiles = np.percentile(totals, [10, 25, 50, 75, 90], method="inverted_cdf")
+    lines = [
+        f"Mean: {totals.mean():.2f}",
+        f"Std dev: {totals.std():.2f}",
+        f"Min: {totals.min()} | Max: {totals.max()}",
+        f"Percentiles: {' | '.join(f'{p}%: {int(v)}' for p, v in zip([10, 25, 50, 75, 90], percentiles))}",
+        "",
+    ]
+    return "\n".join(lines + histogram(totals))
+
+
+def histogram(totals: np.ndarray) -> list:
+    """Renders simulated totals as text bars, one per value or per range of values when there are many"""
+    low, high = int(totals.min()), int(totals.max())
+    width = max(1, -(-(high - low + 1) // HISTOGRAM_BINS))
+    counts = np.bincount((totals - low) // width)
+
+    labels = []
+    for start in range(low, high + 1, width):
+        end = min(high, start + width - 1)
+        labels.append(str(start) if start == end else f"{start}-{end}")
+    pad = max(len(label) for label in labels)
+    peak = counts.max()
+
+    lines = []
+    for label, amount in zip(labels, counts):
+        fill = "#" * int(round(amount / peak * HISTOGRAM_WIDTH))
+        lines.append(f"{label.rjust(pad)} | {fill.ljust(HISTOGRAM_WIDTH)} {amount / len(totals) * 100:5.1f}%")
+    return lines
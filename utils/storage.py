@@ -0,0 +1,682 @@
+"""Bot State Persistence"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.schema import migrate, normalize
+
+
+def encode(value):
+    """Serializes the objects held in the state tree, such as characters, to their JSON form"""
+    return value.to_json()
+
+
+class Storage:
+    """Base class for the bot state backends
+
+    The bot state is a tree of guild -> users/sessions/encounters dicts. Every mutation is applied to the resident
+    tree and recorded as a compact record, either ["s", path, value] or ["d", path]. Records are
+    serialized when made, so later in-place changes never leak into them, and are handed to the backend
+    by a debounced background flush. Records are idempotent, so replaying them is always safe.
+
+    Guilds are loaded on first access, migrated to the current schema and normalized, and evicted once idle for
+    too long, or least recently used first when more than max_guilds are loaded. The limit counts guilds, not
+    bytes, so set it from the memory a typical guild takes. Guilds pinned by a running command are never evicted.
+    """
+
+    def __init__(self, interval: float = 5.0, max_delay: float = 30.0, idle_time: float = 3600.0, max_guilds: int = 1000):
+        self.interval = interval
+        self.max_delay = max_delay
+        self.idle_time = idle_time
+        self.max_guilds = max_guilds
+        self.data = {}
+        self.flushes = 0
+        self.loads = 0
+        self.evictions = 0
+
+        self._pending = []
+        self._pending_since = 0.0
+        self._dirty = set()
+        self._accessed = OrderedDict()
+        self._loading = {}
+        self._pins = {}
+        self._locks = {}
+        self._changed = asyncio.Event()
+        self._over_limit = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._evict_lock = asyncio.Lock()
+        self._tasks = []
+
+    @property
+    def resident(self) -> int:
+        """Number of guilds currently loaded in memory"""
+        return len(self.data)
+
+    @property
+    def pending(self) -> int:
+        """Number of records waiting to be flushed"""
+        return len(self._pending)
+
+    async def open(self) -> None:
+        """Opens the backend and starts the background flush and eviction tasks"""
+        await self._open()
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._evict_loop())]
+
+    async def close(self) -> None:
+        """Stops the background tasks, writes any pending changes and closes the backend"""
+        for task in self._tasks:
+            # Before Python 3.12, asyncio.wait_for drops a cancellation that races with its wait, so cancel until it sticks
+            while not task.done():
+                task.cancel()
+                await asyncio.wait([task], timeout=1.0)
+        self._tasks = []
+        await self.flush()
+        await self._close()
+
+    async def load_guild(self, guild: str) -> dict:
+        """Returns the state of a guild, loading it from the backend if it is not resident"""
+        if guild not in self.data:
+            # Concurrent loads of the same guild share a single backend read
+            task = self._loading.get(guild)
+            if task is None:
+                task = self._loading[guild] = asyncio.create_task(self._load_guild(guild))
+                task.add_done_callback(lambda _: self._loading.pop(guild, None))
+            state = await asyncio.shield(task)
+
+            if guild not in self.data:
+                self.data[guild] = state
+                for record in migrate(guild, state):
+                    self._record(record)
+                normalize(state)
+                self.loads += 1
+                if len(self.data) > self.max_guilds:
+                    self._over_limit.set()
+
+        self._touch(guild)
+        return self.data[guild]
+
+    async def pin(self, guild: str) -> dict:
+        """Loads a guild and keeps it resident until it is unpinned"""
+        self._pins[guild] = self._pins.get(guild, 0) + 1
+        self._locks.setdefault(guild, asyncio.Lock())
+        return await self.load_guild(guild)
+
+    def unpin(self, guild: str) -> None:
+        """Releases a guild pinned by pin"""
+        self._pins[guild] -= 1
+        if not self._pins[guild]:
+            del self._pins[guild]
+            del self._locks[guild]
+        self._touch(guild)
+
+    def lock(self, guild: str) -> asyncio.Lock:
+        """Returns the lock that serializes changes to a pinned guild
+
+        The lock lives as long as the guild is pinned, so only holders of a pin may wait on it.
+        """
+        return self._locks[guild]
+
+    def set(self, path: list, value) -> None:
+        """Sets the value at the given state path and records the change"""
+        record = ["s", path, value]
+        self._apply(self.data, record)
+        self._record(record)
+
+    def delete(self, path: list) -> None:
+        """Deletes the value at the given state path and records the change"""
+        record = ["d", path]
+        self._apply(self.data, record)
+        self._record(record)
+
+    async def flush(self) -> None:
+        """Hands the pending records to the backend"""
+        async with self._lock:
+            if self._pending:
+                lines, self._pending = self._pending, []
+                guilds, self._dirty = self._dirty, set()
+                self._changed.clear()
+                try:
+                    await self._write(lines, guilds)
+                    self.flushes += 1
+                except (OSError, sqlite3.Error):
+                    self._pending = lines + self._pending
+                    self._dirty |= guilds
+                    raise
+
+    async def evict(self) -> int:
+        """Writes back and drops the guilds that are idle or over the guild limit, returning how many were evicted"""
+        async with self._evict_lock:
+            return await self._evict()
+
+    async def _evict(self) -> int:
+        now = asyncio.get_running_loop().time()
+        excess = len(self.data) - self.max_guilds
+        candidates = []
+        for guild, accessed in self._accessed.items():
+            if guild in self._pins:
+                continue
+            if now - accessed < self.idle_time and len(candidates) >= excess:
+                break
+            candidates.append(guild)
+
+        if not candidates:
+            return 0
+
+        # Dirty shards must reach the backend before they are dropped
+        await self.flush()
+        await self._write_back(candidates)
+
+        evicted = 0
+        for guild in candidates:
+            # Skip guilds that were used or changed while writing back
+            if guild in self._pins or guild in self._dirty or self._accessed.get(guild, now) > now:
+                continue
+            self.data.pop(guild, None)
+            self._accessed.pop(guild, None)
+            evicted += 1
+
+        self.evictions += evicted
+        if evicted:
+            logging.info("Evicted %d guilds (%d resident, %d evicted in total)", evicted, self.resident, self.evictions)
+        return evicted
+
+    async def _open(self) -> None:
+        raise NotImplementedError
+
+    async def _close(self) -> None:
+        pass
+
+    async def _load_guild(self, guild: str) -> dict:
+        raise NotImplementedError
+
+    async def _write(self, lines: list, guilds: set) -> None:
+        raise NotImplementedError
+
+    async def _write_back(self, guilds: list) -> None:
+        pass
+
+    def _touch(self, guild: str) -> None:
+        self._accessed[guild] = asyncio.get_running_loop().time()
+        self._accessed.move_to_end(guild)
+
+    def _record(self, record: list) -> None:
+        if not self._pending:
+            self._pending_since = asyncio.get_running_loop().time()
+        self._pending.append(json.dumps(record, separators=(",", ":"), default=encode))
+        self._dirty.add(record[1][0])
+        self._changed.set()
+
+    @staticmethod
+    def _apply(data: dict, record: list) -> None:
+        node = data
+        path = record[1]
+        for key in path[:-1]:
+            # Objects in the tree, such as characters, expose their dicts as attributes
+            node = node.setdefault(key, {}) if isinstance(node, dict) else getattr(node, key)
+
+        if record[0] == "s":
+            node[path[-1]] = record[2]
+        else:
+            node.pop(path[-1], None)
+
+    async def _flush_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._changed.wait()
+
+            # Debounce: wait for a quiet interval, but never longer than the max delay since the first change
+            while True:
+                self._changed.clear()
+                timeout = min(self.interval, self._pending_since + self.max_delay - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self.flush()
+            except (OSError, sqlite3.Error) as ex:
+                logging.exception(ex)
+                await asyncio.sleep(self.interval)
+
+    async def _evict_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._over_limit.wait(), min(self.idle_time, 60.0))
+            except asyncio.TimeoutError:
+                pass
+            self._over_limit.clear()
+
+            try:
+                await self.evict()
+            except (OSError, sqlite3.Error) as ex:
+                logging.exception(ex)
+
+
+class MemoryStorage(Storage):
+    """Keeps the bot state in memory only, for benchmarks and offline use of the command engine
+
+    Evicted guilds are parked in a side table and handed back when they are loaded again.
+    """
+
+    def __init__(self, interval: float = 5.0, max_delay: float = 30.0, idle_time: float = 3600.0, max_guilds: int = 1000):
+        super().__init__(interval, max_delay, idle_time, max_guilds)
+        self._evicted = {}
+
+    async def _open(self) -> None:
+        pass
+
+    async def _load_guild(self, guild: str) -> dict:
+        return self._evicted.pop(guild, {})
+
+    async def _write(self, lines: list, guilds: set) -> None:
+        pass
+
+    async def _write_back(self, guilds: list) -> None:
+        for guild in guilds:
+            if guild in self.data:
+                self._evicted[guild] = self.data[guild]
+
+
+class JSONStorage(Storage):
+    """Journaled persistence of the bot state to per-guild JSON shards
+
+    Each guild lives in its own shard file, read on first access. Records are appended to a shared journal
+    on every flush, so write cost scales with the size of the change. Once the journal grows past the
+    compaction threshold, the shards of the guilds it touched are rewritten and the journal starts over.
+    A legacy single-file cache.json is split into shards on first start.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        interval: float = 5.0,
+        max_delay: float = 30.0,
+        compact_size: int = 1048576,
+        idle_time: float = 3600.0,
+        max_guilds: int = 1000,
+    ):
+        super().__init__(interval, max_delay, idle_time, max_guilds)
+        self.shards = os.path.join(directory, "guilds")
+        self.journal = os.path.join(directory, "journal.log")
+        self.legacy = os.path.join(directory, "cache.json")
+        self.compact_size = compact_size
+        self.compactions = 0
+
+        self._journal_size = 0
+        self._journal_guilds = set()
+
+    def exists(self) -> bool:
+        """Checks whether there is any JSON state on disk"""
+        return any(os.path.exists(path) for path in [self.shards, self.journal, self.legacy])
+
+    def recover(self) -> None:
+        """Folds the legacy snapshot and any journal left by the last run into the shards"""
+        os.makedirs(self.shards, exist_ok=True)
+
+        state = {}
+        if os.path.exists(self.legacy):
+            with open(self.legacy, "rt", encoding="utf-8") as fd:
+                state = json.load(fd)
+
+        for record in self._read_journal():
+            guild = record[1][0]
+            if guild not in state:
+                state[guild] = self._read_shard(guild)
+            self._apply(state, record)
+
+        for guild, shard in state.items():
+            self._write_file(self._shard_path(guild), json.dumps(shard))
+        self._truncate_journal()
+
+        if os.path.exists(self.legacy):
+            os.replace(self.legacy, f"{self.legacy}.migrated")
+
+    def load_all(self) -> dict:
+        """Loads the state of every guild from disk"""
+        self.recover()
+        return {name[:-5]: self._read_shard(name[:-5]) for name in os.listdir(self.shards) if name.endswith(".json")}
+
+    def archive(self) -> None:
+        """Moves the JSON state aside once it has been migrated to another backend"""
+        for path in [self.shards, self.journal]:
+            if os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+
+    async def flush(self) -> None:
+        """Appends the pending records to the journal, compacting it if it grew too large"""
+        await super().flush()
+        if self._journal_size >= self.compact_size:
+            await self.compact()
+
+    async def compact(self) -> None:
+        """Rewrites the shards of the journaled guilds and starts a new journal"""
+        async with self._lock:
+            # Serialize on the event loop so the shards are consistent, then write them from a thread.
+            # Records made after this point are still pending and land in the fresh journal.
+            guilds, self._journal_guilds = self._journal_guilds, set()
+            payloads = {guild: json.dumps(self.data[guild], default=encode) for guild in guilds if guild in self.data}
+            try:
+                await asyncio.to_thread(self._write_shards, payloads, True)
+            except OSError:
+                self._journal_guilds |= guilds
+                raise
+            self._journal_size = 0
+            self.compactions += 1
+
+    async def _open(self) -> None:
+        await asyncio.to_thread(self.recover)
+
+    async def _load_guild(self, guild: str) -> dict:
+        return await asyncio.to_thread(self._read_shard, guild)
+
+    async def _write(self, lines: list, guilds: set) -> None:
+        self._journal_size += await asyncio.to_thread(self._append_journal, lines)
+        self._journal_guilds |= guilds
+
+    async def _write_back(self, guilds: list) -> None:
+        async with self._lock:
+            # Evicted guilds are no longer around for compaction, so their shards are rewritten now
+            guilds = [guild for guild in guilds if guild in self.data]
+            payloads = {guild: json.dumps(self.data[guild], default=encode) for guild in guilds}
+            self._journal_guilds -= set(guilds)
+            try:
+                await asyncio.to_thread(self._write_shards, payloads, False)
+            except OSError:
+                self._journal_guilds |= set(guilds)
+                raise
+
+    def _shard_path(self, guild: str) -> str:
+        return os.path.join(self.shards, f"{guild}.json")
+
+    def _read_shard(self, guild: str) -> dict:
+        try:
+            with open(self._shard_path(guild), "rt", encoding="utf-8") as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {}
+
+    def _read_journal(self) -> list:
+        try:
+            with open(self.journal, "rb") as fd:
+                journal = fd.read()
+        except FileNotFoundError:
+            return []
+
+        records = []
+        offset = 0
+        while offset < len(journal):
+            end = journal.find(b"\n", offset)
+            try:
+                if end == -1:
+                    raise ValueError("Unterminated journal record")
+                records.append(json.loads(journal[offset:end]))
+            except ValueError:
+                # Only the record being written during a crash can be torn, so drop it and everything after it
+                logging.warning("Truncating torn journal record at %s:%d", self.journal, offset)
+                os.truncate(self.journal, offset)
+                break
+            offset = end + 1
+        return records
+
+    def _append_journal(self, lines: list) -> int:
+        payload = "".join(f"{line}\n" for line in lines).encode("utf-8")
+        with open(self.journal, "ab") as fd:
+            fd.write(payload)
+            fd.flush()
+            os.fsync(fd.fileno())
+        return len(payload)
+
+    def _truncate_journal(self) -> None:
+        with open(self.journal, "wb") as fd:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def _write_shards(self, payloads: dict, truncate: bool) -> None:
+        for guild, payload in payloads.items():
+            self._write_file(self._shard_path(guild), payload)
+
+        # The shards now hold every journaled record, so the journal can start over
+        if truncate:
+            self._truncate_journal()
+
+    @staticmethod
+    def _write_file(path: str, payload: str) -> None:
+        fd, tmp = tempfile.mkstemp(prefix=".shard-", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wt", encoding="utf-8") as tmpfd:
+                tmpfd.write(payload)
+                tmpfd.flush()
+                os.fsync(tmpfd.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+class SQLiteStorage(Storage):
+    """Persistence of the bot state to an SQLite database
+
+    Guilds are loaded on first access with indexed per-guild queries, and every record is translated into
+    point writes on the matching table. All queries run on a dedicated worker thread that owns the connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guilds (guild TEXT PRIMARY KEY, wday INTEGER NOT NULL DEFAULT -1, version INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS users (
+            guild TEXT NOT NULL, user TEXT NOT NULL, name TEXT NOT NULL DEFAULT '', active TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (guild, user)
+        );
+        CREATE TABLE IF NOT EXISTS characters (
+            guild TEXT NOT NULL, user TEXT NOT NULL, name TEXT NOT NULL, sheet TEXT NOT NULL,
+            PRIMARY KEY (guild, user, name)
+        );
+        CREATE TABLE IF NOT EXISTS macros (
+            guild TEXT NOT NULL, user TEXT NOT NULL, character TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL,
+            PRIMARY KEY (guild, user, character, name)
+        );
+        CREATE TABLE IF NOT EXISTS variables (
+            guild TEXT NOT NULL, user TEXT NOT NULL, character TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL,
+            PRIMARY KEY (guild, user, character, name)
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            guild TEXT NOT NULL, kind TEXT NOT NULL, date TEXT NOT NULL,
+            PRIMARY KEY (guild, kind, date)
+        );
+        CREATE TABLE IF NOT EXISTS unavailability (
+            guild TEXT NOT NULL, user TEXT NOT NULL, date TEXT NOT NULL,
+            PRIMARY KEY (guild, user, date)
+        );
+        CREATE TABLE IF NOT EXISTS encounters (
+            guild TEXT NOT NULL, channel TEXT NOT NULL, state TEXT NOT NULL,
+            PRIMARY KEY (guild, channel)
+        );
+    """
+
+    def __init__(
+        self,
+        path: str,
+        legacy: JSONStorage = None,
+        interval: float = 5.0,
+        max_delay: float = 30.0,
+        idle_time: float = 3600.0,
+        max_guilds: int = 1000,
+    ):
+        super().__init__(interval, max_delay, idle_time, max_guilds)
+        self.path = path
+        self.legacy = legacy
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    async def _open(self) -> None:
+        await self._run(self._connect)
+
+    async def _close(self) -> None:
+        # The connection is only made by open, which may have failed or never run
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown()
+
+    async def _load_guild(self, guild: str) -> dict:
+        return await self._run(self._select_guild, guild)
+
+    async def _write(self, lines: list, guilds: set) -> None:
+        await self._run(self._apply_records, [json.loads(line) for line in lines])
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> None:
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        if "version" not in [column[1] for column in self._conn.execute("PRAGMA table_info(guilds)")]:
+            self._conn.execute("ALTER TABLE guilds ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+        if self.legacy is not None and self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+            self._migrate(self.legacy)
+
+    def _migrate(self, legacy: JSONStorage) -> None:
+        """One-shot import of an existing JSON state"""
+        if not legacy.exists():
+            return
+
+        records = []
+        for guild, state in legacy.load_all().items():
+            for key, value in state.get("sessions", {}).items():
+                records.append(["s", [guild, "sessions", key], value])
+            for channel, encounter in state.get("encounters", {}).items():
+                records.append(["s", [guild, "encounters", channel], encounter])
+            for user, profile in state.get("users", {}).items():
+                for key, value in profile.items():
+                    if key == "characters":
+                        for name, character in value.items():
+                            records.append(["s", [guild, "users", user, "characters", name], character])
+                    else:
+                        records.append(["s", [guild, "users", user, key], value])
+        self._apply_records(records)
+
+        legacy.archive()
+        logging.info("Migrated %d records from %s into %s", len(records), legacy.shards, self.path)
+
+    def _select_guild(self, guild: str) -> dict:
+        conn = self._conn
+        state = {"users": {}, "sessions": {"on": [], "off": [], "wday": -1}, "encounters": {}}
+
+        row = conn.execute("SELECT wday, version FROM guilds WHERE guild = ?", (guild,)).fetchone()
+        if row is not None:
+            state["sessions"]["wday"], state["version"] = row
+
+        for kind, date in conn.execute("SELECT kind, date FROM sessions WHERE guild = ? ORDER BY date", (guild,)):
+            state["sessions"][kind].append(date)
+
+        for user, name, active in conn.execute("SELECT user, name, active FROM users WHERE guild = ?", (guild,)):
+            state["users"][user] = {"name": name, "active": active, "characters": {}, "unavailability": []}
+
+        for user, date in conn.execute("SELECT user, date FROM unavailability WHERE guild = ? ORDER BY date", (guild,)):
+            if user in state["users"]:
+                state["users"][user]["unavailability"].append(date)
+
+        for user, name, sheet in conn.execute("SELECT user, name, sheet FROM characters WHERE guild = ?", (guild,)):
+            character = json.loads(sheet)
+            character["macros"] = {}
+            character["variables"] = {}
+            if user in state["users"]:
+                state["users"][user]["characters"][name] = character
+
+        for table in ["macros", "variables"]:
+            for user, character, name, value in conn.execute(f"SELECT user, character, name, value FROM {table} WHERE guild = ?", (guild,)):
+                characters = state["users"].get(user, {}).get("characters", {})
+                if character in characters:
+                    characters[character][table][name] = value
+
+        for channel, encounter in conn.execute("SELECT channel, state FROM encounters WHERE guild = ?", (guild,)):
+            state["encounters"][channel] = json.loads(encounter)
+
+        return state
+
+    def _apply_records(self, records: list) -> None:
+        with self._conn as conn:
+            for record in records:
+                try:
+                    self._apply_record(conn, record)
+                except ValueError as ex:
+                    logging.error("Dropping record: %s", ex)
+
+    def _apply_record(self, conn: sqlite3.Connection, record: list) -> None:
+        # pylint: disable=too-many-branches
+        op, path = record[0], record[1]
+        value = record[2] if op == "s" else None
+        guild = path[0]
+
+        if path[1:] == ["version"]:
+            conn.execute(
+                "INSERT INTO guilds (guild, version) VALUES (?, ?) ON CONFLICT (guild) DO UPDATE SET version = excluded.version", (guild, value)
+            )
+
+        elif path[1:2] == ["sessions"] and len(path) == 3:
+            if path[2] == "wday":
+                conn.execute("INSERT INTO guilds (guild, wday) VALUES (?, ?) ON CONFLICT (guild) DO UPDATE SET wday = excluded.wday", (guild, value))
+            else:
+                conn.execute("DELETE FROM sessions WHERE guild = ? AND kind = ?", (guild, path[2]))
+                conn.executemany("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?)", [(guild, path[2], date) for date in value or []])
+
+        elif path[1:2] == ["users"] and len(path) == 4 and path[3] in ["name", "active"]:
+            conn.execute(
+                f"INSERT INTO users (guild, user, {path[3]}) VALUES (?, ?, ?) ON CONFLICT (guild, user) DO UPDATE SET {path[3]} = excluded.{path[3]}",
+                (guild, path[2], value or ""),
+            )
+
+        elif path[1:2] == ["users"] and len(path) == 4 and path[3] == "unavailability":
+            conn.execute("INSERT OR IGNORE INTO users (guild, user) VALUES (?, ?)", (guild, path[2]))
+            conn.execute("DELETE FROM unavailability WHERE guild = ? AND user = ?", (guild, path[2]))
+            conn.executemany("INSERT OR IGNORE INTO unavailability VALUES (?, ?, ?)", [(guild, path[2], date) for date in value or []])
+
+        elif path[1:2] == ["users"] and len(path) == 5 and path[3] == "characters":
+            key = (guild, path[2], path[4])
+            conn.execute("INSERT OR IGNORE INTO users (guild, user) VALUES (?, ?)", key[:2])
+            for table in ["macros", "variables"]:
+                conn.execute(f"DELETE FROM {table} WHERE guild = ? AND user = ? AND character = ?", key)
+
+            if op == "s":
+                sheet = {k: v for k, v in value.items() if k not in ["macros", "variables"]}
+                conn.execute("INSERT OR REPLACE INTO characters VALUES (?, ?, ?, ?)", key + (json.dumps(sheet),))
+                for table in ["macros", "variables"]:
+                    conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?)", [key + item for item in value.get(table, {}).items()])
+            else:
+                conn.execute("DELETE FROM characters WHERE guild = ? AND user = ? AND name = ?", key)
+
+        elif path[1:2] == ["users"] and len(path) == 7 and path[3] == "characters" and path[5] in ["macros", "variables"]:
+            key = (guild, path[2], path[4], path[6])
+            if op == "s":
+                conn.execute(f"INSERT OR REPLACE INTO {path[5]} VALUES (?, ?, ?, ?, ?)", key + (value,))
+            else:
+                conn.execute(f"DELETE FROM {path[5]} WHERE guild = ? AND user = ? AND character = ? AND name = ?", key)
+
+        elif path[1:2] == ["encounters"] and len(path) == 3:
+            if op == "s":
+                conn.execute("INSERT OR REPLACE INTO encounters VALUES (?, ?, ?)", (guild, path[2], json.dumps(value)))
+            else:
+                conn.execute("DELETE FROM encounters WHERE guild = ? AND channel = ?", (guild, path[2]))
+
+        elif path[1:2] == ["encounters"] and len(path) == 4 and op == "s":
+            # Turn advances update a single field in place instead of rewriting the combatants
+            conn.execute(
+                "UPDATE encounters SET state = json_set(state, '$.' || ?, json(?)) WHERE guild = ? AND channel = ?",
+                (path[3], json.dumps(value), guild, path[2]),
+            )
+
+        else:
+            raise ValueError(f"Unsupported storage path {path}")
@@ -5,6 +5,7 @@ HELP_MSG_1 = (
     "```"
     "!roll <dice>                                                   # Roll the dice using dice notation\n"
     "!roll [<character>] <skill|macro> [crit] [save] [a|ta|d] [var] # Roll a character's stat, save or skill check\n"
+    "!odds [<character>] <skill|macro|dice> [...] vs <DC>           # Exact odds of meeting a DC (same options as !roll)\n"
     "\n"
     "!distance <ground> <vertical> <diagonal>                       # Calculates distances (use 0 to indicate the one to calculate)\n"
     "\n"
@@ -39,6 +40,14 @@ HELP_MSG_2 = (
     "  - delete [<character>] <name>                 # Delete a variable from a character\n"
     "  - list [<character>]                          # List all the variables for a character\n"
     "  - help                                        # Show more detailed help\n"
+    "\n"
+    "!roll party <skill|macro> [...]                 # Everyone with an active character rolls (same options as !roll)\n"
+    "!roll <character>,<character>,... <skill> [...] # Several of your characters roll (same options as !roll)\n"
+    "!roll <roll>; <roll>; ...                       # Several rolls answered at once\n"
+    "!roll <count>x [<character>] <skill|macro|dice> # Roll many times at once (same options as !roll)\n"
+    "!sim <count> [<character>] <skill|macro|dice>   # Simulate many rolls and show statistics (same options as !roll)\n"
+    "!history [<count>] [me|<player>]                # Latest rolls of this channel, or of a player\n"
+    "!luck [me|<player>]                             # How a player's dice compare with fair dice\n"
     "```"
 )
 
@@ -95,7 +104,8 @@ VARS_HELP = (
     " - Proficiency Bonus:   $prof\n"
     " - Ability Scores:      $<score>      # (Example: $str)\n"
     " - Ability Modifiers:   $<score>_mod  # (Example: $wis_mod)\n"
-    " - Skills:              $<skill>      # (Example: $insight)\n\n"
+    " - Skills:              $<skill>      # (Example: $insight)\n"
+    " - Other Variables:     $<variable>   # (Example: $rage)\n\n"
     "```"
 )
 
@@ -113,3 +123,18 @@ SESSION_HELP = (
     "  - help                          # Show this help.\n"
     "```"
 )
+
+INIT_HELP = (
+    "Available Initiative Tracking Commands (can be shorthanded to the first letter):\n"
+    "```"
+    "!init                                 # Track the initiative order of this channel's encounter.\n"
+    "  - add [<character>] [a|d]           # Roll initiative for one of your characters (the active one if omitted).\n"
+    "  - add <name> <initiative> [<dex>]   # Add a combatant with a fixed initiative and dex modifier.\n"
+    "  - roll <count>x <name> [<dex>]      # Roll initiative for several combatants at once, numbered from <name>1.\n"
+    "  - next                              # Move to the next combatant's turn.\n"
+    "  - remove <name>                     # Remove a combatant from the encounter.\n"
+    "  - show                              # Show the initiative order and whose turn it is.\n"
+    "  - end                               # End the encounter.\n"
+    "  - help                              # Show this help.\n"
+    "```"
+)